@@ -1,24 +1,73 @@
 import argparse
+import csv
+import glob
+import hashlib
+import importlib.util
 import logging
 import os
+import re
 import sys
-import pandas as pd
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 """
-Usage: run.py [-h] -i --input-file [-f --output-filename] [-cc] [-d]
+Usage: run.py [-h] -i --input-file [-f --output-filename] [-cc] [--chunk-size ROWS] [-w WORKERS]
+              [--engine {auto,pandas,pyarrow,csv}] [--index INDEX_FILE [--compact-index] [--rebuild-index OUTPUT_CSV ...]] [-d]
 
 Provide anz bank statement and it will concat the fields to create a concatenated description field  
 
 optional arguments:
   -h, --help            show this help message and exit
-  -i --input-file       The csv input file bank statement from ANZ
-  -f --output-filename  filename of the output csv
+  -i --input-file       The csv input file bank statement from ANZ, or a directory or glob of them
+                        to convert in batch mode (the file type is detected from each header)
+  -f --output-filename  filename of the output csv, or the output directory in batch mode
   -cc                   Use this flag if it is a Credit Card input file
+  --chunk-size ROWS     Stream the statement through ROWS rows at a time, for large exports
+  -w WORKERS            Files converted at once in batch mode, defaults to the number of CPUs
+  --engine ENGINE       auto (default) converts small statements with the csv module and large ones
+                        with pandas (reading with pyarrow when installed), or force pandas, pyarrow or csv.
+                        They all write the same output
+  --index INDEX_FILE    Incremental mode, only write transactions that aren't already in this
+                        fingerprint index and add the new ones to it
+  --compact-index       Drop duplicate fingerprints from the --index file
+  --rebuild-index OUTPUT_CSV ...
+                        Rebuild the --index file from previously exported output files
   -d                    Enable debug mode
 
 """
 
+# Header columns that identify each kind of ANZ export
+ACCOUNT_HEADER = {'Type', 'Details', 'Particulars', 'Code', 'Reference'}
+CC_HEADER = {'Card', 'Details', 'TransactionDate'}
+
+# Fields joined into the Description and the columns written out for each kind of export
+ACCOUNT_DESCRIPTION = ['Type', 'Details', 'Particulars', 'Code', 'Reference']
+CC_DESCRIPTION = ['Card', 'Details']
+ACCOUNT_COLUMNS = ['Date', 'Description', 'Amount']
+CC_COLUMNS = ['TransactionDate', 'Description', 'NewAmount']
+# The only input columns each transform reads
+ACCOUNT_INPUT = ACCOUNT_DESCRIPTION + ['Amount', 'Date']
+CC_INPUT = CC_DESCRIPTION + ['Type', 'Amount', 'TransactionDate']
+
+# The auto engine uses the csv module for statements up to this size and pandas above it,
+# the csv module stays ahead up to around 250k rows (14MB) once the pandas import is counted
+CSV_ENGINE_MAX_BYTES = 8 * 1024 * 1024
+
+# Incremental mode index records, a blake2b digest of each exported transaction's fingerprint
+INDEX_RECORD_SIZE = 8
+FINGERPRINT_SEPARATOR = '\x1f'
+
+# Amount text once the dollar sign and thousands separators are gone, at most two decimal places
+AMOUNT_PATTERN = r'[-+]?[0-9]+(?:\.[0-9]{0,2})?'
+AMOUNT_RE = re.compile(AMOUNT_PATTERN)
+
+
+class AmountError(ValueError):
+    """
+    An Amount that isn't a plain amount of money
+    """
+
 
 def init(argv):
     """
@@ -44,24 +93,61 @@ def init(argv):
     # Get the arguments
     parser = argparse.ArgumentParser(
         description='Provide anz bank statement and it will concat the fields to create a concatenated description field')
-    parser.add_argument('-i', required=True, metavar='--input-file',
-                        help="The csv input file bank statement from ANZ")
+    parser.add_argument('-i', metavar='--input-file',
+                        help="The csv input file bank statement from ANZ, or a directory or glob of them to convert in batch")
     parser.add_argument('-f', metavar='--output-filename',
-                        help="filename of the output csv, defaults to input file + output")
+                        help="filename of the output csv, defaults to input file + output. The output directory in batch mode, defaults to ./output")
     parser.add_argument('-cc', action="store_true",
                         help="Use this flag if it is a Credit Card input file", default=False)
+    parser.add_argument('--chunk-size', type=int, default=0, metavar='ROWS',
+                        help="Stream the statement through ROWS rows at a time instead of reading it all in, for large exports")
+    parser.add_argument('-w', type=int, default=os.cpu_count() or 1, metavar='WORKERS',
+                        help="Files converted at once in batch mode, defaults to the number of CPUs")
+    parser.add_argument('--engine', choices=['auto', 'pandas', 'pyarrow', 'csv'], default='auto',
+                        help="Conversion engine, auto uses the csv module for small statements and pandas for large ones, "
+                             "reading them with pyarrow when it is installed")
+    parser.add_argument('--index', metavar='INDEX_FILE',
+                        help="Only write transactions that aren't already in this fingerprint index, and add the new ones to it")
+    parser.add_argument('--compact-index', action="store_true",
+                        help="Drop duplicate fingerprints from the --index file, then convert -i if given")
+    parser.add_argument('--rebuild-index', nargs='+', metavar='OUTPUT_CSV',
+                        help="Rebuild the --index file from previously exported output files, then convert -i if given")
     parser.add_argument('-d', action="store_true", help='Enable debug mode')
     args = parser.parse_args(argv)
+    if (args.compact_index or args.rebuild_index) and not args.index:
+        parser.error("--compact-index and --rebuild-index need --index")
+    if not args.i and not (args.compact_index or args.rebuild_index):
+        parser.error("the following arguments are required: -i")
+    if args.chunk_size < 0:
+        parser.error("--chunk-size must be 0 or more")
+    if args.w < 1:
+        parser.error("-w must be 1 or more")
+    if args.engine == 'pyarrow' and args.chunk_size:
+        parser.error("--chunk-size needs the pandas or csv engine, pyarrow reads the whole statement")
+    if args.engine == 'pyarrow' and not pyarrow_available():
+        parser.error("--engine pyarrow needs pyarrow, install it with 'pip install pyarrow'")
     logging.info(args)
 
     # Set the variables from user input
-    global input_filename, output_filename, is_cc_file
+    global input_filename, output_filename, is_cc_file, chunk_size, batch, workers
+    global index_filename, compact, rebuild_files, engine
     input_filename = args.i
+    index_filename = args.index
+    compact = args.compact_index
+    rebuild_files = args.rebuild_index
+    # A directory or a glob pattern converts every statement it matches
+    batch = bool(input_filename) and (os.path.isdir(input_filename) or glob.has_magic(input_filename))
     if args.f:
         output_filename = args.f
+    elif batch:
+        output_filename = "output"
     else:
         output_filename = "output" + str(input_filename).replace('\\', '')
     is_cc_file = args.cc
+    chunk_size = args.chunk_size
+    workers = args.w
+    # Chunked reading is a pandas feature, so asking for chunks on auto keeps to pandas
+    engine = 'pandas' if args.engine == 'auto' and chunk_size else args.engine
     if args.d:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -75,64 +161,507 @@ def end():
     logging.info("FINISH script with runtime of: " + str(run_time))
 
 
+def read_header(filename):
+    """
+    The statement's header row, None for an empty file
+    """
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f), None)
+
+
+def pyarrow_available():
+    """
+    Whether pyarrow is installed for the pyarrow reader, without paying for importing it
+    """
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def read_statement(filename, columns, chunk_size=None, reader='c'):
+    """
+    Read just the columns the transform needs from the statement with pandas, a chunk_size rows at a time
+    or all of it in one frame. They are pinned to str so there is no type inference and a chunk can't
+    read differently to the whole file. Raises KeyError if one of the columns is missing.
+    The pyarrow reader is much faster but stricter, a statement it rejects is read again with the C reader
+    """
+    header = read_header(filename)
+    if header is not None:
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise KeyError(missing[0])
+
+    # pandas is slow to import, leave it until the arguments have been checked
+    import pandas as pd
+    # Only empty fields are blank, a Reference of "NA" or "null" is kept as it is
+    options = {'usecols': columns, 'dtype': dict((column, str) for column in columns),
+               'keep_default_na': False, 'na_values': ['']}
+    if reader == 'pyarrow' and not chunk_size:
+        try:
+            return iter([pd.read_csv(filename, engine='pyarrow', **options)])
+        except pd.errors.ParserError:
+            logging.info("pyarrow could not read " + filename + ", reading it with the C reader", exc_info=True)
+    # Extra trailing fields are dropped rather than shifting the columns along by becoming the index
+    options['index_col'] = False
+    if chunk_size:
+        return pd.read_csv(filename, chunksize=chunk_size, **options)
+    return iter([pd.read_csv(filename, **options)])
+
+
+def parse_cents(amounts):
+    """
+    Parse amount text like "-1,234.5" or "$12.50" into whole cents in an Int64 column.
+    Blank amounts stay NA, anything else that isn't a plain amount raises AmountError
+    """
+    text = amounts.str.replace(',', '', regex=False).str.replace('$', '', regex=False).str.strip()
+    valid = text.str.fullmatch(AMOUNT_PATTERN).fillna(False).astype(bool)
+    bad = text.notna() & (text != '') & ~valid
+    if bad.any():
+        raise AmountError("Amount could not be parsed: '" + str(amounts[bad].iloc[0]) + "'")
+    # At most two decimal places, so rounding the float back to cents is exact for anything under 2**53 cents
+    return (text.where(valid).astype('float64') * 100).round().astype('Int64')
+
+
+def format_cents(cents):
+    """
+    Write whole cents back out as amount text with two decimal places, NA stays blank
+    """
+    return (cents / 100).map('{:.2f}'.format, na_action='ignore')
+
+
+def join_fields(df, fields):
+    """
+    Join text fields with single spaces, skipping blank ones rather than writing "nan"
+    """
+    import numpy
+    import pandas as pd
+    joined = df[fields[0]].fillna('').astype(str)
+    for field in fields[1:]:
+        value = df[field].fillna('').astype(str)
+        both = ((joined != '') & (value != '')).to_numpy(dtype=bool)
+        separator = pd.Series(numpy.where(both, ' ', ''), index=df.index, dtype=joined.dtype)
+        joined = joined + separator + value
+    return joined
+
+
+def transform(df, is_cc_file):
+    """
+    Build the Description field and the cleaned up Amount (NewAmount for credit cards),
+    returns the frame and the columns to write out. Raises KeyError on the wrong file type
+    and AmountError on an amount that can't be parsed
+    """
+    if is_cc_file is False:
+        df['Description'] = join_fields(df, ACCOUNT_DESCRIPTION)
+        columns = ACCOUNT_COLUMNS
+    else:
+        # Set the cc headers we are concat for desc, there are less of them
+        df['Description'] = join_fields(df, CC_DESCRIPTION)
+        columns = CC_COLUMNS
+        is_debit = df['Type'] == 'D'
+
+    # Parse the amounts once into whole cents, this drops the comma and dollar sign
+    cents = parse_cents(df['Amount'])
+    if is_cc_file is False:
+        df['Amount'] = format_cents(cents)
+    else:
+        # we need to add the minus symbol again cause ANZ fluffed it :/ debits are always money out
+        df['NewAmount'] = format_cents(cents.abs().mul(-1).where(is_debit, cents))
+
+    # Set the columns to return back in the CSV file
+    logging.debug(df[columns])
+    return df, columns
+
+
+def read_statement_rows(filename, required):
+    """
+    Read the statement with the csv module as dicts of column to text, skipping blank lines, filling short
+    rows with blanks and dropping extra trailing fields the same way pandas does when reading only the columns
+    it needs. Raises KeyError if a required column is missing
+    """
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise csv.Error("No columns to parse from file")
+        missing = [column for column in required if column not in header]
+        if missing:
+            raise KeyError(missing[0])
+        for row in reader:
+            if not row or (len(row) == 1 and not row[0].strip()):
+                continue
+            if len(row) < len(header):
+                row = row + [''] * (len(header) - len(row))
+            yield dict(zip(header, row[:len(header)]))
+
+
+def parse_amount_cents(amount):
+    """
+    The csv engine's parse_cents for a single amount, None when blank
+    """
+    text = amount.replace(',', '').replace('$', '').strip()
+    if text == '':
+        return None
+    if not AMOUNT_RE.fullmatch(text):
+        raise AmountError("Amount could not be parsed: '" + amount + "'")
+    return int(round(float(text) * 100))
+
+
+def format_amount_cents(cents):
+    """
+    The csv engine's format_cents for a single amount
+    """
+    return '' if cents is None else '{:.2f}'.format(cents / 100)
+
+
+def transform_row(row, is_cc_file):
+    """
+    The csv engine's transform for one row, returns the output values.
+    Raises KeyError on the wrong file type and AmountError on an amount that can't be parsed
+    """
+    if is_cc_file is False:
+        description = ' '.join(row[field] for field in ACCOUNT_DESCRIPTION if row[field] != '')
+        return [row['Date'], description, format_amount_cents(parse_amount_cents(row['Amount']))]
+    description = ' '.join(row[field] for field in CC_DESCRIPTION if row[field] != '')
+    cents = parse_amount_cents(row['Amount'])
+    # debits are always money out
+    if cents is not None and row['Type'] == 'D':
+        cents = -abs(cents)
+    return [row['TransactionDate'], description, format_amount_cents(cents)]
+
+
+def convert_rows_csv(input_filename, output_filename, is_cc_file, exported, new_digests):
+    """
+    Convert a statement with only the standard library, row by row. Writes the same bytes as the
+    pandas engine for small statements where importing pandas costs more than the conversion.
+    Returns (rows written, rows skipped as already exported)
+    """
+    columns = CC_COLUMNS if is_cc_file else ACCOUNT_COLUMNS
+    counts = {}
+    rows = 0
+    skipped = 0
+    with open(output_filename, 'w', newline='', encoding='utf-8') as f:
+        # lineterminator and quoting match pandas to_csv
+        writer = csv.writer(f, lineterminator=os.linesep, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(columns)
+        for row in read_statement_rows(input_filename, CC_INPUT if is_cc_file else ACCOUNT_INPUT):
+            values = transform_row(row, is_cc_file)
+            if exported is not None:
+                digest = fingerprint(FINGERPRINT_SEPARATOR.join(values), counts)
+                if digest in exported:
+                    skipped += 1
+                    continue
+                new_digests.append(digest)
+            writer.writerow(values)
+            rows += 1
+    return rows, skipped
+
+
+def convert_rows_pandas(input_filename, output_filename, is_cc_file, chunk_size, exported, new_digests, reader='c'):
+    """
+    Convert a statement with pandas, a chunk at a time when chunk_size is set.
+    Returns (rows written, rows skipped as already exported)
+    """
+    counts = {}
+    rows = 0
+    skipped = 0
+    first = True
+    for df in read_statement(input_filename, CC_INPUT if is_cc_file else ACCOUNT_INPUT, chunk_size, reader):
+        df, columns = transform(df, is_cc_file)
+        if exported is not None:
+            digests = fingerprint_rows(df, columns, counts)
+            is_new = [digest not in exported for digest in digests]
+            new_digests.extend(digest for digest, new in zip(digests, is_new) if new)
+            skipped += len(df) - sum(is_new)
+            df = df[is_new]
+        # The first chunk starts the file with the header, the rest are appended
+        df.to_csv(output_filename, columns=columns, index=False,
+                  mode='w' if first else 'a', header=first)
+        first = False
+        rows += len(df)
+        logging.debug("Written " + str(rows) + " rows to " + output_filename)
+    return rows, skipped
+
+
+def pick_engine(input_filename, engine):
+    """
+    Resolve the auto engine, the csv module for statements small enough that importing pandas
+    would take longer than converting them, otherwise pandas with the pyarrow reader when it is installed
+    """
+    if engine != 'auto':
+        return engine
+    if os.path.getsize(input_filename) <= CSV_ENGINE_MAX_BYTES:
+        return 'csv'
+    return 'pyarrow' if pyarrow_available() else 'pandas'
+
+
+def detect_file_type(filename):
+    """
+    Sniff the header row to tell a credit card export from an account export,
+    returns True for credit card. Raises ValueError if it is neither
+    """
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        header = set(next(csv.reader(f), []))
+    if CC_HEADER <= header:
+        return True
+    if ACCOUNT_HEADER <= header:
+        return False
+    raise ValueError("Unrecognised header, expected " + ",".join(sorted(ACCOUNT_HEADER)) +
+                     " or " + ",".join(sorted(CC_HEADER)))
+
+
+def fingerprint_rows(df, columns, counts):
+    """
+    Fingerprint each output row from its date, description and amount plus how many times that same
+    transaction has already appeared in this statement, so genuine repeats (two coffees on the same day)
+    are kept apart. counts carries the occurrences across the chunks of one statement
+    """
+    values = df[columns].fillna('').astype(str)
+    keys = values[columns[0]]
+    for column in columns[1:]:
+        keys = keys + FINGERPRINT_SEPARATOR + values[column]
+    return [fingerprint(key, counts) for key in keys.tolist()]
+
+
+def fingerprint(key, counts):
+    """
+    Digest of one row's fingerprint key and its occurrence number
+    """
+    occurrence = counts.get(key, 0)
+    counts[key] = occurrence + 1
+    return hashlib.blake2b((key + FINGERPRINT_SEPARATOR + str(occurrence)).encode('utf-8'),
+                           digest_size=INDEX_RECORD_SIZE).digest()
+
+
+def load_index(filename):
+    """
+    Load the fingerprint index into a set for O(1) lookups, a missing index is empty.
+    A torn record at the end from an interrupted append is ignored
+    """
+    if not os.path.exists(filename):
+        return set()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    end = len(data) - len(data) % INDEX_RECORD_SIZE
+    return {data[i:i + INDEX_RECORD_SIZE] for i in range(0, end, INDEX_RECORD_SIZE)}
+
+
+def append_index(filename, digests):
+    """
+    Append new fingerprints to the index, first cutting off any torn record so the file stays aligned
+    """
+    if not digests:
+        return
+    with open(filename, 'ab') as f:
+        size = f.tell()
+        if size % INDEX_RECORD_SIZE:
+            f.truncate(size - size % INDEX_RECORD_SIZE)
+            f.seek(0, os.SEEK_END)
+        f.write(b''.join(digests))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_index(filename, digests):
+    """
+    Replace the index with these fingerprints in one go, sorted and without duplicates
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(b''.join(sorted(digests)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+def compact_index(filename):
+    """
+    Rewrite the index without duplicate or torn records, returns (records before, records after)
+    """
+    before = os.path.getsize(filename) // INDEX_RECORD_SIZE if os.path.exists(filename) else 0
+    digests = load_index(filename)
+    write_index(filename, digests)
+    return before, len(digests)
+
+
+def rebuild_index(filename, output_files):
+    """
+    Rebuild the index from previously exported output files, returns the number of fingerprints.
+    Incremental outputs only hold the transactions new to each run and never overlap, so the occurrences
+    are counted across all of them: a coffee repeated in a later export carries on from the earlier ones
+    """
+    digests = set()
+    counts = {}
+    for output_file in output_files:
+        with open(output_file, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if row:
+                    digests.add(fingerprint(FINGERPRINT_SEPARATOR.join(row), counts))
+    write_index(filename, digests)
+    return len(digests)
+
+
+def convert_file(input_filename, output_filename, is_cc_file, chunk_size=None, index_filename=None, engine='auto'):
+    """
+    Convert one statement with the chosen engine, returns the number of rows written.
+    With an index only the transactions it doesn't already hold are written, and they are added to it
+    once the output is complete
+    """
+    exported = load_index(index_filename) if index_filename else None
+    new_digests = []
+    engine = pick_engine(input_filename, engine)
+    logging.info("Converting " + input_filename + " with the " + engine + " engine")
+    # Write to a temporary file and swap it in once complete, so an output named the same as the input
+    # can't truncate the statement before it has been read and a failed conversion leaves no partial output
+    temp_filename = output_filename + '.tmp'
+    try:
+        if engine == 'csv':
+            rows, skipped = convert_rows_csv(input_filename, temp_filename, is_cc_file, exported, new_digests)
+        else:
+            rows, skipped = convert_rows_pandas(input_filename, temp_filename, is_cc_file, chunk_size, exported, new_digests,
+                                                'pyarrow' if engine == 'pyarrow' else 'c')
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    os.replace(temp_filename, output_filename)
+
+    if exported is not None:
+        append_index(index_filename, new_digests)
+        logging.info("Skipped " + str(skipped) + " rows of " + input_filename + " already in " + index_filename)
+    return rows
+
+
+def convert_batch_file(job):
+    """
+    Worker for batch mode, converts one file picking the transform from its header.
+    Returns a summary of the file rather than raising so one bad file doesn't stop the batch
+    """
+    input_filename, output_filename, chunk_size, index_filename, engine = job
+    summary = {'file': input_filename, 'output': output_filename, 'type': '', 'rows': 0, 'seconds': 0.0, 'error': None}
+    start = time.perf_counter()
+    try:
+        is_cc_file = detect_file_type(input_filename)
+        summary['type'] = 'credit card' if is_cc_file else 'account'
+        summary['rows'] = convert_file(input_filename, output_filename, is_cc_file, chunk_size, index_filename, engine)
+    except Exception as e:
+        logging.exception("Failed to convert " + input_filename)
+        summary['error'] = str(e) or type(e).__name__
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def batch_files(pattern):
+    """
+    The statements a batch covers, every .csv in a directory or the files matching a glob
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f))
+
+
+def run_batch(pattern, output_dir, workers, chunk_size, index_filename=None, engine='auto'):
+    """
+    Convert every statement in the batch across worker processes and print a per-file summary,
+    returns the number of files that failed. With an index the files are converted one after another
+    in name order, so overlapping statements in the same batch are only written once
+    """
+    files = batch_files(pattern)
+    if not files:
+        print("No csv files found for " + pattern)
+        return 0
+
+    # Outputs keep the input file names, so two inputs with the same name would overwrite each other
+    names = [os.path.basename(f) for f in files]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        print("Input files share names, convert them separately: " + ", ".join(duplicates))
+        return len(files)
+
+    # Outputs written next to their inputs would replace the statements being converted
+    if os.path.isdir(output_dir) and any(os.path.samefile(output_dir, os.path.dirname(f) or '.') for f in files):
+        print("The output directory " + output_dir + " holds the statements being converted, pick another with -f")
+        return len(files)
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(f, os.path.join(output_dir, os.path.basename(f)), chunk_size, index_filename, engine) for f in files]
+    if index_filename:
+        logging.info("Converting " + str(len(jobs)) + " files into " + output_dir + " one at a time against " + index_filename)
+        summaries = [convert_batch_file(job) for job in jobs]
+    else:
+        logging.info("Converting " + str(len(jobs)) + " files into " + output_dir + " with " + str(workers) + " workers")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            summaries = list(executor.map(convert_batch_file, jobs))
+
+    print("{:<40} {:<12} {:>10} {:>9}  {}".format('file', 'type', 'rows', 'seconds', 'status'))
+    for summary in summaries:
+        status = 'FAILED: ' + summary['error'] if summary['error'] else 'ok'
+        print("{:<40} {:<12} {:>10} {:>9.2f}  {}".format(
+            os.path.basename(summary['file']), summary['type'], summary['rows'], summary['seconds'], status))
+        logging.info(summary)
+    failed = sum(1 for summary in summaries if summary['error'])
+    print("Converted " + str(len(summaries) - failed) + " of " + str(len(summaries)) + " files, " +
+          str(sum(summary['rows'] for summary in summaries)) + " rows")
+    return failed
+
+
 def main(argv):
     """
-    Guts of the program, takes input, manipulates it and spits it back out
+    Guts of the program, takes input, manipulates it and spits it back out.
+    A directory or glob as input converts every statement in it in parallel
     """
     init(argv)
 
-    # Get the filename again and read the csv
+    global input_filename, output_filename, is_cc_file, chunk_size, batch, workers
+    global index_filename, compact, rebuild_files, engine
+
     try:
-        global input_filename
-        logging.info(input_filename)
-        df = pd.read_csv(input_filename)
-    except Exception:
-        err_str = "Error while reading input csv file, check the logs for more..."
+        if rebuild_files:
+            print("Rebuilt " + index_filename + " with " + str(rebuild_index(index_filename, rebuild_files)) + " fingerprints")
+        if compact:
+            before, after = compact_index(index_filename)
+            print("Compacted " + index_filename + " from " + str(before) + " to " + str(after) + " fingerprints")
+    except OSError:
+        err_str = "Error while updating the fingerprint index, check the logs for more..."
         print(err_str)
         logging.exception(err_str)
         print("Exiting script with errors.")
         quit()
+    if not input_filename:
+        end()
+        return
 
-    global is_cc_file
-    try:
-        if is_cc_file is False:
-            # Set the headers we are concat for desc
-            df['Description'] = df['Type'].map(str) + " " + df['Details'].map(str) + " " + \
-                df['Particulars'].map(str) + " " + df['Code'].map(str) + \
-                " " + df['Reference'].map(str)
-            columns = ['Date', 'Description', 'Amount']
-        else:
-            # Set the cc headers we are concat for desc, there are less of them
-            df['Description'] = df['Card'].map(
-                str) + " " + df['Details'].map(str)
-            columns = ['TransactionDate', 'Description', 'NewAmount']
-
-            # we need to add the minus symbol again cause ANZ fluffed it :/
-            df.loc[df['Type'] == 'D', 'NewAmount'] = "-" + \
-                df['Amount'].map(str)
-            df.loc[df['Type'] != 'D', 'NewAmount'] = df['Amount']
+    logging.info(input_filename)
+    logging.info(output_filename)
 
-            logging.debug(df[columns])
+    if batch:
+        if run_batch(input_filename, output_filename, workers, chunk_size, index_filename, engine):
+            print("Exiting script with errors.")
+            quit()
+        end()
+        return
 
+    try:
+        rows = convert_file(input_filename, output_filename, is_cc_file, chunk_size, index_filename, engine)
     except KeyError:
         err_str = "Error when creating new Description field, you probably forgot the -cc flag or included it for a non Credit Card file. Check logs for more details..."
         print(err_str)
         logging.exception(err_str)
         print("Exiting script with errors.")
         quit()
+    except AmountError as e:
+        err_str = "Error while converting the Amount field: " + str(e)
+        print(err_str)
+        logging.exception(err_str)
+        print("Exiting script with errors.")
+        quit()
+    except Exception:
+        err_str = "Error while reading input csv file, check the logs for more..."
+        print(err_str)
+        logging.exception(err_str)
+        print("Exiting script with errors.")
+        quit()
 
-    # remove the comma and dollar sign
-    df['Amount'] = df['Amount'].astype(str)
-    df['Amount'] = df['Amount'].str.replace(',', '', regex=True)
-    df['Amount'] = df['Amount'].str.replace('$', '', regex=True)
-
-    # Set the columns to return back in the CSV file
-    logging.debug(df[columns])
-
-    global output_filename
-    logging.info(output_filename)
-    df.to_csv(output_filename,
-              columns=columns, index=False)
+    logging.info("Converted " + str(rows) + " rows")
 
     # Write out runtime and complete final tasks
     end()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Benchmark the engines of anz-to-mybooster-csv.py end to end
+#
+# Runs the converter as a child process with each --engine on synthetic account statements of
+# increasing size (optionally with extra unused columns), so the pandas import is counted, reporting
+# wall time and peak RSS, and checks every engine writes byte-identical output and that an index rebuilt
+# from incremental outputs still skips every transaction they hold.
+# Used to pick CSV_ENGINE_MAX_BYTES for the auto engine
+#
+# For usage please execute: "$ python3 benchmarks/bench_anz_engines.py -h"
+#
+import argparse
+import filecmp
+import importlib.util
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONVERTER = os.path.join(ROOT, 'anz-to-mybooster-csv.py')
+ENGINES = ['pandas', 'pyarrow', 'csv', 'auto'] if importlib.util.find_spec('pyarrow') else ['pandas', 'csv', 'auto']
+
+################################################################################
+# Synthetic account statement with blanks, $ and thousands separators like a real export. Every 1000th
+# row has an extra trailing field, which every engine drops
+def syntheticStatement(fileName, count, wide=0, seed=1):
+  rand = random.Random(seed)
+  amounts = ['-12.50', '1000', '"$1,234.56"', '0.1', '-3', '']
+  extraHeader = ''.join(',Extra' + str(n) for n in range(wide))
+  extra = ',unused' * wide
+  with open(fileName, 'w') as f:
+    f.write('Type,Details,Particulars,Code,Reference,Amount,Date,ForeignCurrencyAmount,ConversionCharge' + extraHeader + '\n')
+    for i in range(count):
+      particulars = 'P' + str(i) if i % 7 else ''
+      code = str(i % 999) if i % 5 else ''
+      trailing = ',extra' if i % 1000 == 999 else ''
+      f.write('%s,Shop %d,%s,%s,REF%d,%s,%02d/01/2024,,%s%s\n' % (rand.choice(['Eft-Pos', 'Payment', 'Transfer']), i, particulars, code, i, rand.choice(amounts), i % 28 + 1, extra, trailing))
+
+# Best wall time in seconds and peak RSS in MB of converting with an engine
+def timeEngine(statement, output, engine, repeat, workDir):
+  best = None
+  peak = 0
+  for _ in range(repeat):
+    start = time.perf_counter()
+    child = subprocess.Popen([sys.executable, CONVERTER, '-i', statement, '-f', output, '--engine', engine], cwd=workDir, stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of just this child, ru_maxrss is in kilobytes on Linux
+    _, status, usage = os.wait4(child.pid, 0)
+    elapsed = time.perf_counter() - start
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode:
+      raise RuntimeError(engine + ' engine failed on ' + statement)
+    best = elapsed if best is None else min(best, elapsed)
+    peak = max(peak, usage.ru_maxrss / 1024.0)
+  return best, peak
+
+# Convert a statement with an engine, returns the number of rows written
+def convert(workDir, engine, *arguments):
+  subprocess.run([sys.executable, CONVERTER, '--engine', engine] + list(arguments), cwd=workDir, stdout=subprocess.DEVNULL, check=True)
+  with open(os.path.join(workDir, arguments[arguments.index('-f') + 1])) as f:
+    return sum(1 for _ in f) - 1
+
+# One coffee in the first statement and the same coffee twice in the second, exported incrementally, then
+# the index is rebuilt from the two outputs. Re-running the second statement must write nothing
+def checkIndexRebuild(workDir, engine):
+  header = 'Type,Details,Particulars,Code,Reference,Amount,Date,ForeignCurrencyAmount,ConversionCharge\n'
+  coffee = 'Eft-Pos,Cafe,,,,-4.50,02/01/2024,,\n'
+  for name, rows in (('s1.csv', 1), ('s2.csv', 2)):
+    with open(os.path.join(workDir, name), 'w') as f:
+      f.write(header + coffee * rows)
+  for name in ('idx', 'rebuilt.idx'):
+    if os.path.exists(os.path.join(workDir, name)):
+      os.remove(os.path.join(workDir, name))
+  assert convert(workDir, engine, '-i', 's1.csv', '-f', 'o1.csv', '--index', 'idx') == 1
+  assert convert(workDir, engine, '-i', 's2.csv', '-f', 'o2.csv', '--index', 'idx') == 1
+  subprocess.run([sys.executable, CONVERTER, '--index', 'rebuilt.idx', '--rebuild-index', 'o1.csv', 'o2.csv'], cwd=workDir, stdout=subprocess.DEVNULL, check=True)
+  assert convert(workDir, engine, '-i', 's2.csv', '-f', 'o3.csv', '--index', 'rebuilt.idx') == 0, engine + ' engine exported a transaction the rebuilt index holds'
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark the pandas and csv engines of the ANZ converter across statement sizes')
+  parser.add_argument('-n', type=int, nargs='+', default=[100, 1000, 10000, 100000, 1000000], metavar='ROWS', help='Statement sizes in rows (default: 100 1000 10000 100000 1000000)')
+  parser.add_argument('-r', type=int, default=3, help='Repeats, the best time is kept (default: 3)')
+  parser.add_argument('--wide', type=int, default=0, metavar='COLUMNS', help='Extra unused columns in each statement (default: 0)')
+  args = parser.parse_args(argv)
+
+  workDir = tempfile.mkdtemp(prefix='bench_anz_engines_')
+  print('%10s %10s  %s' % ('rows', 'size KB', '  '.join('%16s' % (engine + ' s / MB') for engine in ENGINES)))
+  try:
+    for engine in ENGINES:
+      checkIndexRebuild(workDir, engine)
+    for count in args.n:
+      statement = os.path.join(workDir, 'statement_%d.csv' % count)
+      syntheticStatement(statement, count, args.wide)
+      results = []
+      outputs = []
+      for engine in ENGINES:
+        output = os.path.join(workDir, 'output_%d_%s.csv' % (count, engine))
+        results.append(timeEngine(statement, output, engine, args.r, workDir))
+        outputs.append(output)
+      for output in outputs[1:]:
+        assert filecmp.cmp(outputs[0], output, shallow=False), output + ' differs from the pandas engine output'
+      print('%10d %10d  %s' % (count, os.path.getsize(statement) // 1024, '  '.join('%8.3f / %5d' % (seconds, peak) for seconds, peak in results)))
+  finally:
+    shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#
+# End to end benchmark of men_and_mice_report.py against the local mock api
+#
+# Starts benchmarks/mock_men_and_mice.py in process, then runs the report as a child process for
+# each scenario and range count, reporting wall time, peak RSS of the report and the number of
+# api requests it issued, and how many of them the mock turned away as over its --capacity.
+# Extra report arguments can be given after --, e.g. -- --adaptive-rate
+#
+# For usage please execute: "$ python3 benchmarks/bench_men_and_mice_report.py -h"
+#
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_men_and_mice as mock
+
+REPORT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'men_and_mice_report.py')
+
+# name -> extra report arguments
+SCENARIOS = {
+  'default': [],
+  'stream-json': ['--stream-json'],
+  'csv': ['-o', 'report.csv'],
+  'filtered': ['--min-utilisation', '80', '--subnets-only'],
+  'rollup': ['--rollup'],
+}
+
+################################################################################
+# Run the report once as a child process, returns (exit code, seconds, peak RSS in MB)
+def runReport(port, addressSpaces, arguments, workDir):
+  env = dict(os.environ, MM_PASSWORD='bench')
+  command = [sys.executable, REPORT, '-s', '127.0.0.1:' + str(port), '-u', 'bench', '-a', addressSpaces] + arguments
+  with open(os.path.join(workDir, 'stderr.txt'), 'w+') as errors:
+    start = time.perf_counter()
+    child = subprocess.Popen(command, cwd=workDir, env=env, stdout=subprocess.DEVNULL, stderr=errors)
+    # wait4 gives the resource usage of just this child
+    _, status, usage = os.wait4(child.pid, 0)
+    seconds = time.perf_counter() - start
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode:
+      errors.seek(0)
+      print(errors.read(), file=sys.stderr)
+  # ru_maxrss is in kilobytes on Linux
+  return child.returncode, seconds, usage.ru_maxrss / 1024.0
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark men_and_mice_report.py end to end against a local mock api')
+  parser.add_argument('-n', type=int, nargs='+', default=[1000, 10000, 100000], metavar='RANGES', help='Ranges per address space to run with (default: 1000 10000 100000)')
+  parser.add_argument('--address-spaces', type=int, default=1, help='Address spaces on the mock, all of them are reported on (default: 1)')
+  parser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), default=['default'], help='Report scenarios to run (default: default)')
+  parser.add_argument('--latency', type=float, default=0.0, metavar='MS', help='Delay the mock adds to every request in milliseconds')
+  parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION', help='Fraction of mock requests answered with a 503')
+  parser.add_argument('--capacity', type=int, metavar='REQUESTS', help='Requests a second the mock serves before answering 429')
+  parser.add_argument('--keep', action='store_true', help='Keep the working directories with the reports and logs')
+  parser.add_argument('extra', nargs='*', help='Extra arguments passed to every report run, after --')
+  args = parser.parse_args(argv)
+
+  addressSpaces = 'all' if args.address_spaces > 1 else '1'
+  print('%-12s %10s %10s %10s %10s %10s  %s' % ('scenario', 'ranges', 'seconds', 'peak MB', 'requests', 'rejected', 'exit'))
+  for count in args.n:
+    server, state = mock.startServer(ranges=count, addressSpaces=args.address_spaces, latency=args.latency / 1000.0, errorRate=args.error_rate, capacity=args.capacity)
+    try:
+      for scenario in args.scenario:
+        workDir = tempfile.mkdtemp(prefix='bench_mm_')
+        # the report logs to ./logs
+        os.mkdir(os.path.join(workDir, 'logs'))
+        state.resetStats()
+        code, seconds, peak = runReport(server.server_port, addressSpaces, SCENARIOS[scenario] + args.extra, workDir)
+        stats = state.stats()
+        print('%-12s %10d %10.2f %10.1f %10d %10d  %d' % (scenario, count, seconds, peak, stats['requests'], stats['rejected'], code))
+        if args.keep:
+          print('  kept ' + workDir)
+        else:
+          shutil.rmtree(workDir)
+    finally:
+      server.shutdown()
+      server.server_close()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#
+# Benchmark for building the men and mice range report from api ranges
+#
+# Compares the original per-range dict loop + per-cell applymap against the columnar
+# rangesToFrame + escapeIllegalCharacters path on synthetic ranges, and checks both
+# produce the same data frame
+#
+# For usage please execute: "$ python3 benchmarks/bench_report_build.py -h"
+#
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+import men_and_mice_report as report
+from men_and_mice_report import it
+
+################################################################################
+# Synthetic ranges shaped like the Ranges api output, a few with characters that need escaping
+def syntheticRanges(count, seed=1):
+  rand = random.Random(seed)
+  ranges = []
+  for i in range(count):
+    a, b = divmod(i, 256)
+    customProperties = {it.TITLE: 'Range ' + str(i), it.SITE_CODE: 'SITE' + str(i % 50)}
+    if i % 3:
+      customProperties[it.DESCRIPTION] = 'Floor ' + str(i % 7) + (' café\tline' if i % 97 == 0 else '')
+    ranges.append({
+      it.NAME: '10.' + str(a % 256) + '.' + str(b) + '.0/24',
+      it.FROM: '10.' + str(a % 256) + '.' + str(b) + '.0',
+      it.TO: '10.' + str(a % 256) + '.' + str(b) + '.255',
+      it.IS_SUBNET: i % 10 != 0,
+      it.IS_CONTAINER: i % 10 == 0,
+      it.UTILIZATION_PERCENTAGE: rand.randint(0, 100),
+      it.CUSTOM_PROPS: customProperties,
+    })
+  return ranges
+
+################################################################################
+# The report build as it was before the columnar path
+def legacyBuild(rangesArr):
+  minimisedRanges = []
+  for range in rangesArr:
+    tempRangeAttributes = {}
+    customProperties = range[it.CUSTOM_PROPS]
+    if it.TITLE in customProperties:
+        tempRangeAttributes[it.TITLE] = range[it.CUSTOM_PROPS][it.TITLE]
+    if it.DESCRIPTION in customProperties:
+        tempRangeAttributes[it.DESCRIPTION] = range[it.CUSTOM_PROPS][it.DESCRIPTION]
+    if it.SITE_CODE in customProperties:
+        tempRangeAttributes['SiteCode'] = range[it.CUSTOM_PROPS][it.SITE_CODE]
+    if it.UTILIZATION_PERCENTAGE in range:
+        tempRangeAttributes[it.UTILIZATION_PERCENTAGE] = range[it.UTILIZATION_PERCENTAGE]
+    if it.NAME in range:
+        tempRangeAttributes[it.NAME] = range[it.NAME]
+    if it.IS_SUBNET in range:
+        tempRangeAttributes[it.IS_SUBNET] = range[it.IS_SUBNET]
+    if it.IS_CONTAINER in range:
+        tempRangeAttributes[it.IS_CONTAINER] = range[it.IS_CONTAINER]
+    if it.FROM in range:
+        tempRangeAttributes[it.FROM] = range[it.FROM]
+    if it.TO in range:
+        tempRangeAttributes[it.TO] = range[it.TO]
+    minimisedRanges.append(tempRangeAttributes)
+
+  df = pd.DataFrame(data=minimisedRanges, columns=report.REPORT_COLUMNS)
+  # applymap was renamed to map in pandas 2.1
+  cellMap = getattr(df, 'map', None) or df.applymap
+  return cellMap(lambda x: x.encode('unicode_escape').decode('utf-8') if isinstance(x, str) else x)
+
+def columnarBuild(rangesArr):
+  return report.escapeIllegalCharacters(report.rangesToFrame(rangesArr))
+
+# Best of a few runs so a noisy neighbour doesn't skew the numbers
+def bestTime(function, argument, repeat):
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = function(argument)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+################################################################################
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark the legacy vs columnar range report build')
+  parser.add_argument('-n', type=int, default=100000, metavar='RANGES', help='Number of synthetic ranges (default: 100000)')
+  parser.add_argument('-r', type=int, default=3, metavar='REPEAT', help='Runs per implementation, best is reported (default: 3)')
+  args = parser.parse_args(argv)
+
+  rangesArr = syntheticRanges(args.n)
+
+  legacyTime, legacyDf = bestTime(legacyBuild, rangesArr, args.r)
+  columnarTime, columnarDf = bestTime(columnarBuild, rangesArr, args.r)
+
+  # Both paths must produce the same report, blanks may be None or NaN depending on the path
+  pd.testing.assert_frame_equal(
+    legacyDf.astype(object).where(legacyDf.notna(), None),
+    columnarDf.astype(object).where(columnarDf.notna(), None)
+  )
+
+  print("ranges:    " + str(args.n))
+  print("legacy:    %.3fs" % legacyTime)
+  print("columnar:  %.3fs" % columnarTime)
+  print("speedup:   %.1fx" % (legacyTime / columnarTime))
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
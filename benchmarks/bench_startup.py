@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Startup benchmark for the scripts in the repo root
+#
+# Times "-h", an argument error and getting as far as the password prompt for each script as a child
+# process, and runs them under "python -X importtime" to check pandas, requests and urllib3 are not
+# imported before then. Exits non zero if a heavy module is imported early or a run is over --max-ms
+#
+# For usage please execute: "$ python3 benchmarks/bench_startup.py -h"
+#
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ['men_and_mice_report.py', 'anz-to-mybooster-csv.py', 'python-boilerplate.py']
+HEAVY_MODULES = ('pandas', 'requests', 'urllib3', 'numpy')
+
+# name -> arguments, the argument error is a missing required argument
+CASES = {
+  'help': ['-h'],
+  'bad-args': [],
+}
+# script -> arguments that get it to the password prompt, run without a terminal and with stdin closed so
+# the prompt reads end of file and the script stops there
+PROMPT_CASES = {
+  'men_and_mice_report.py': ['-s', 'mm-server', '-u', 'username', '-a', 'all'],
+  'python-boilerplate.py': ['-s', 'http://couchdb:5984', '--db', 'devices', '-u', 'username', '-f', 'devices.csv'],
+}
+# Unset so the scripts prompt for the password rather than read it from the environment
+PASSWORD_VARIABLES = ('MM_PASSWORD', 'COUCHDB_PASSWORD')
+
+################################################################################
+# Run the script in workDir with no terminal to prompt on, a new session has no /dev/tty for getpass
+def runScript(command, workDir, stderr):
+  env = dict((name, value) for name, value in os.environ.items() if name not in PASSWORD_VARIABLES)
+  return subprocess.run(command, cwd=workDir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr, text=True, start_new_session=True)
+
+# Best and mean wall time in milliseconds of running the script with these arguments
+def timeRun(script, arguments, repeat, workDir):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    runScript([sys.executable, os.path.join(ROOT, script)] + arguments, workDir, subprocess.DEVNULL)
+    times.append((time.perf_counter() - start) * 1000)
+  return min(times), sum(times) / len(times)
+
+# Heavy top level modules imported while running the script with these arguments
+def heavyImports(script, arguments, workDir):
+  result = runScript([sys.executable, '-X', 'importtime', os.path.join(ROOT, script)] + arguments, workDir, subprocess.PIPE)
+  imported = set()
+  for line in result.stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    module = line.rsplit('|', 1)[-1].strip()
+    if module in HEAVY_MODULES:
+      imported.add(module)
+  return sorted(imported)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark script startup for -h, argument errors and the password prompt')
+  parser.add_argument('-r', type=int, default=5, help='Runs per script and case (default: 5)')
+  parser.add_argument('--max-ms', type=float, default=None, help='Fail if the best run of any script and case is slower than this')
+  args = parser.parse_args(argv)
+
+  workDir = tempfile.mkdtemp(prefix='bench_startup_')
+  # the boilerplate checks its input file is there before it prompts
+  with open(os.path.join(workDir, 'devices.csv'), 'w') as f:
+    f.write('_id,name\n')
+  start = time.perf_counter()
+  subprocess.run([sys.executable, '-c', 'pass'])
+  print('bare interpreter %.1f ms' % ((time.perf_counter() - start) * 1000))
+  print('%-26s %-9s %9s %9s  %s' % ('script', 'case', 'best ms', 'mean ms', 'heavy imports'))
+  failed = False
+  for script in SCRIPTS:
+    cases = dict(CASES)
+    if script in PROMPT_CASES:
+      cases['password'] = PROMPT_CASES[script]
+    for case, arguments in cases.items():
+      best, mean = timeRun(script, arguments, args.r, workDir)
+      imported = heavyImports(script, arguments, workDir)
+      print('%-26s %-9s %9.1f %9.1f  %s' % (script, case, best, mean, ', '.join(imported) or '-'))
+      if imported or (args.max_ms is not None and best > args.max_ms):
+        failed = True
+  if failed:
+    print('Startup regressed, see above')
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Local CouchDB stand-in, enough of it for python-boilerplate.py's device loading
+#
+# Keeps databases in memory and serves GET/PUT /db, POST /db (one document) and POST /db/_bulk_docs
+# with CouchDB's per-document results: new documents get an id and rev, writing an existing _id
+# without its current _rev is a conflict. Requests are counted so batching can be measured.
+#
+# For usage please execute: "$ python3 benchmarks/mock_couchdb.py -h"
+#
+import argparse
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+################################################################################
+# The server state shared by the request handlers
+class couchState:
+  def __init__(self, databases=(), latency=0.0):
+    self.databases = dict((name, {}) for name in databases)
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.requestsByPath = {}
+
+  def count(self, path):
+    with self.lock:
+      self.requests += 1
+      self.requestsByPath[path] = self.requestsByPath.get(path, 0) + 1
+
+  def stats(self):
+    with self.lock:
+      return {
+        "requests": self.requests,
+        "requestsByPath": dict(self.requestsByPath),
+        "documents": dict((name, len(docs)) for name, docs in self.databases.items()),
+      }
+
+  def resetStats(self):
+    with self.lock:
+      self.requests = 0
+      self.requestsByPath = {}
+
+  # Store one document the way CouchDB does, returns its result row
+  def save(self, docs, doc):
+    docId = doc.get("_id") or uuid.uuid4().hex
+    current = docs.get(docId)
+    if current is not None and doc.get("_rev") != current["_rev"]:
+      return {"id": docId, "error": "conflict", "reason": "Document update conflict."}
+    generation = int(current["_rev"].split("-")[0]) + 1 if current else 1
+    stored = dict(doc, _id=docId, _rev=str(generation) + "-" + uuid.uuid4().hex)
+    docs[docId] = stored
+    return {"ok": True, "id": docId, "rev": stored["_rev"]}
+
+class couchHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  state = None
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def body(self):
+    length = int(self.headers.get("Content-Length", "0"))
+    return json.loads(self.rfile.read(length) or b"{}")
+
+  def parts(self):
+    return [unquote(part) for part in urlparse(self.path).path.strip("/").split("/") if part]
+
+  def notFound(self):
+    self.reply(404, {"error": "not_found", "reason": "Database does not exist."})
+
+  def do_GET(self):
+    parts = self.parts()
+    if parts == ["__stats"]:
+      return self.reply(200, self.state.stats())
+    self.state.count(urlparse(self.path).path)
+    if self.state.latency:
+      time.sleep(self.state.latency)
+    if len(parts) == 1:
+      with self.state.lock:
+        docs = self.state.databases.get(parts[0])
+        if docs is None:
+          return self.notFound()
+        return self.reply(200, {"db_name": parts[0], "doc_count": len(docs)})
+    if len(parts) == 2:
+      with self.state.lock:
+        doc = self.state.databases.get(parts[0], {}).get(parts[1])
+      if doc is None:
+        return self.reply(404, {"error": "not_found", "reason": "missing"})
+      return self.reply(200, doc)
+    self.reply(200, {"couchdb": "Welcome", "version": "mock"})
+
+  def do_PUT(self):
+    parts = self.parts()
+    self.state.count(urlparse(self.path).path)
+    if len(parts) != 1:
+      return self.notFound()
+    with self.state.lock:
+      if parts[0] in self.state.databases:
+        return self.reply(412, {"error": "file_exists", "reason": "The database could not be created, the file already exists."})
+      self.state.databases[parts[0]] = {}
+    self.reply(201, {"ok": True})
+
+  def do_POST(self):
+    parts = self.parts()
+    self.state.count(urlparse(self.path).path)
+    body = self.body()
+    if self.state.latency:
+      time.sleep(self.state.latency)
+    with self.state.lock:
+      docs = self.state.databases.get(parts[0]) if parts else None
+      if docs is None:
+        return self.notFound()
+      if parts[1:] == ["_bulk_docs"]:
+        return self.reply(201, [self.state.save(docs, doc) for doc in body.get("docs", [])])
+      if len(parts) == 1:
+        result = self.state.save(docs, body)
+        if "error" in result:
+          return self.reply(409, result)
+        return self.reply(201, result)
+    self.notFound()
+
+# Start the stand-in on a background thread, returns (server, state). Port 0 picks a free port
+def startServer(port=0, databases=(), latency=0.0):
+  state = couchState(databases, latency)
+  handler = type("boundCouchHandler", (couchHandler,), {"state": state})
+  server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, state
+
+################################################################################
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Run a local in-memory CouchDB stand-in')
+  parser.add_argument('--port', type=int, default=5984, help='Port to listen on (default: 5984)')
+  parser.add_argument('--db', nargs='*', default=['devices'], help='Databases to create up front (default: devices)')
+  parser.add_argument('--latency', type=float, default=0.0, metavar='MS', help='Delay added to every request in milliseconds')
+  args = parser.parse_args(argv)
+
+  server, state = startServer(args.port, args.db, args.latency / 1000.0)
+  print("Mock CouchDB on http://127.0.0.1:" + str(server.server_port) + " with databases " + ", ".join(args.db) + ", Ctrl+C to stop")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+#
+# Local stand-in for the Men and Mice REST api, enough of it for men_and_mice_report.py
+#
+# Serves GetCurrentAddressSpace, SetCurrentAddressSpace, AddressSpaces (with the filter= syntax the
+# report uses) and Ranges (limit/offset/filter/fields) with synthetic ranges generated on the fly,
+# so the report can be run and benchmarked without a live IPAM server. The current address space is
+# kept per session cookie like the real server does. With a capacity, requests over that many a second
+# are turned away with a 429 like an overloaded server, to exercise the report's rate limiter.
+#
+# For usage please execute: "$ python3 benchmarks/mock_men_and_mice.py -h"
+#
+import argparse
+import collections
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+################################################################################
+# Synthetic ranges, every block is a /16 container followed by the 256 /24 subnets inside it
+class syntheticSpace:
+  BLOCK = 257
+
+  def __init__(self, ref, name, count, seed):
+    self.ref = ref
+    self.name = name
+    self.count = count
+    self.seed = seed
+    # filter expression -> indexes of the matching ranges
+    self.filtered = {}
+    self.lock = threading.Lock()
+
+  # Build range i, the same i always gives the same range
+  def range(self, i):
+    block, position = divmod(i, syntheticSpace.BLOCK)
+    first = 10 + block // 256
+    second = block % 256
+    rand = random.Random(self.seed * 1000003 + i)
+    siteCode = "SITE" + str(block % 40)
+    if position == 0:
+      name = "%d.%d.0.0/16" % (first, second)
+      start, end = "%d.%d.0.0" % (first, second), "%d.%d.255.255" % (first, second)
+      subnet, container = False, True
+      title = "Container " + str(block)
+    else:
+      third = position - 1
+      name = "%d.%d.%d.0/24" % (first, second, third)
+      start, end = "%d.%d.%d.0" % (first, second, third), "%d.%d.%d.255" % (first, second, third)
+      subnet, container = True, False
+      title = "Subnet " + str(i)
+    customProperties = {"Title": title, "Site Code": siteCode}
+    if i % 3:
+      customProperties["Description"] = "Floor " + str(i % 7) + (" café\tline" if i % 997 == 0 else "")
+    return {
+      "ref": "Ranges/" + str(i + 1),
+      "name": name,
+      "from": start,
+      "to": end,
+      "subnet": subnet,
+      "isContainer": container,
+      "utilizationPercentage": rand.randint(0, 100),
+      "customProperties": customProperties,
+      "childRanges": [],
+      "dhcpScopes": [],
+      "authority": {"name": "mock", "type": "Internal"},
+    }
+
+  # Indexes of the ranges that pass a filter, worked out once per filter expression
+  def matching(self, rangeFilter):
+    if not rangeFilter:
+      return None
+    with self.lock:
+      if rangeFilter not in self.filtered:
+        predicate = parseRangeFilter(rangeFilter)
+        self.filtered[rangeFilter] = [i for i in range(self.count) if predicate(self.range(i))]
+      return self.filtered[rangeFilter]
+
+# Turn the report's filter expression (terms joined with " and ") into a predicate on a range
+def parseRangeFilter(expression):
+  checks = []
+  for term in expression.split(" and "):
+    term = term.strip()
+    match = re.match(r'^(\w+)>=(.+)$', term)
+    if match:
+      field, value = match.group(1), float(match.group(2))
+      checks.append(lambda r, field=field, value=value: r.get(field) is not None and r[field] >= value)
+      continue
+    match = re.match(r'^(\w+)=(true|false)$', term)
+    if match:
+      field, value = match.group(1), match.group(2) == "true"
+      checks.append(lambda r, field=field, value=value: r.get(field) == value)
+      continue
+    match = re.match(r'^"([^"]+)"="(.*)"$', term)
+    if match:
+      field, value = match.group(1), match.group(2)
+      checks.append(lambda r, field=field, value=value: r["customProperties"].get(field) == value)
+      continue
+    match = re.match(r'^(\w+)=@"(.*)"$', term)
+    if match:
+      field, value = match.group(1), match.group(2).lower()
+      checks.append(lambda r, field=field, value=value: value in str(r.get(field, "")).lower())
+      continue
+    raise ValueError("Unsupported filter term: " + term)
+  return lambda r: all(check(r) for check in checks)
+
+################################################################################
+# The server state shared by the request handlers
+class mockState:
+  def __init__(self, ranges, addressSpaces, latency=0.0, errorRate=0.0, seed=1, capacity=None):
+    self.addressSpaces = [
+      syntheticSpace("AddressSpaces/" + str(n + 1), "Space " + str(n + 1), ranges, seed + n)
+      for n in range(addressSpaces)
+    ]
+    self.latency = latency
+    self.errorRate = errorRate
+    self.capacity = capacity
+    # arrival times of the requests in the last second, for the capacity
+    self.arrivals = collections.deque()
+    self.rejected = 0
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    # session cookie -> current address space ref
+    self.sessions = {}
+    self.requests = 0
+    self.requestsByPath = {}
+
+  def count(self, path):
+    with self.lock:
+      self.requests += 1
+      self.requestsByPath[path] = self.requestsByPath.get(path, 0) + 1
+
+  def stats(self):
+    with self.lock:
+      return {"requests": self.requests, "requestsByPath": dict(self.requestsByPath), "sessions": len(self.sessions), "rejected": self.rejected}
+
+  def resetStats(self):
+    with self.lock:
+      self.requests = 0
+      self.requestsByPath = {}
+      self.rejected = 0
+
+  # True when this request takes the server over its capacity for the last second
+  def overloaded(self):
+    if not self.capacity:
+      return False
+    now = time.monotonic()
+    with self.lock:
+      while self.arrivals and self.arrivals[0] <= now - 1.0:
+        self.arrivals.popleft()
+      if len(self.arrivals) >= self.capacity:
+        self.rejected += 1
+        return True
+      self.arrivals.append(now)
+      return False
+
+  def space(self, ref):
+    for space in self.addressSpaces:
+      if space.ref == ref:
+        return space
+    return None
+
+class mockHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  state = None
+
+  def log_message(self, format, *args):
+    pass
+
+  def session(self):
+    cookie = self.headers.get("Cookie", "")
+    match = re.search(r'mmsession=([\w-]+)', cookie)
+    with self.state.lock:
+      if match and match.group(1) in self.state.sessions:
+        return match.group(1), False
+      session = str(uuid.uuid4())
+      self.state.sessions[session] = self.state.addressSpaces[0].ref
+      return session, True
+
+  def reply(self, status, body=None, session=None, headers=None):
+    data = b"" if body is None else json.dumps(body).encode()
+    self.send_response(status)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    if session is not None:
+      self.send_header("Set-Cookie", "mmsession=" + session + "; Path=/")
+    self.end_headers()
+    self.wfile.write(data)
+
+  def delayOrFail(self):
+    if self.state.overloaded():
+      self.reply(429, {"error": {"code": 429, "message": "Too many requests"}}, headers={"Retry-After": "1"})
+      return True
+    if self.state.latency:
+      time.sleep(self.state.latency)
+    with self.state.lock:
+      failed = self.state.errorRate and self.state.random.random() < self.state.errorRate
+    if failed:
+      self.reply(503, {"error": {"code": 503, "message": "Injected failure"}})
+      return True
+    return False
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    if url.path == "/__stats":
+      return self.reply(200, self.state.stats())
+    self.state.count(url.path)
+    if self.delayOrFail():
+      return
+    session, new = self.session()
+    setCookie = session if new else None
+    query = parse_qs(url.query)
+
+    if url.path == "/mmws/api/command/GetCurrentAddressSpace":
+      return self.reply(200, {"result": {"addressSpaceRef": self.state.sessions[session]}}, setCookie)
+
+    if url.path.rstrip("/") == "/mmws/api/AddressSpaces":
+      spaces = self.state.addressSpaces
+      rangeFilter = query.get("filter", [""])[0]
+      match = re.match(r'^ref="(.*)"$', rangeFilter)
+      if match:
+        spaces = [s for s in spaces if s.ref == match.group(1)]
+      match = re.match(r'^name=@"(.*)"$', rangeFilter)
+      if match:
+        spaces = [s for s in spaces if match.group(1).lower() in s.name.lower()]
+      result = [{"ref": s.ref, "name": s.name} for s in spaces]
+      return self.reply(200, {"result": {"addressSpaces": result, "totalResults": len(result)}}, setCookie)
+
+    if url.path.rstrip("/") == "/mmws/api/Ranges":
+      space = self.state.space(self.state.sessions[session])
+      offset = int(query.get("offset", ["0"])[0])
+      limit = int(query.get("limit", [str(space.count)])[0])
+      matching = space.matching(query.get("filter", [""])[0])
+      indexes = range(space.count) if matching is None else matching
+      page = [space.range(i) for i in indexes[offset:offset + limit]]
+      fields = query.get("fields", [""])[0]
+      if fields:
+        keep = set(fields.split(","))
+        page = [dict((k, v) for k, v in r.items() if k in keep) for r in page]
+      return self.reply(200, {"result": {"ranges": page, "totalResults": len(indexes)}}, setCookie)
+
+    self.reply(404, {"error": {"code": 404, "message": "Not found: " + url.path}})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    self.state.count(url.path)
+    length = int(self.headers.get("Content-Length", "0"))
+    body = json.loads(self.rfile.read(length) or b"{}")
+    if self.delayOrFail():
+      return
+    session, new = self.session()
+    setCookie = session if new else None
+
+    if url.path == "/__reset":
+      self.state.resetStats()
+      return self.reply(200, {"result": {}}, setCookie)
+
+    if url.path == "/mmws/api/command/SetCurrentAddressSpace":
+      ref = body.get("addressSpaceRef")
+      if self.state.space(ref) is None:
+        return self.reply(500, {"error": {"code": 500, "message": "No such address space: " + str(ref)}}, setCookie)
+      with self.state.lock:
+        self.state.sessions[session] = ref
+      return self.reply(204, None, setCookie)
+
+    self.reply(404, {"error": {"code": 404, "message": "Not found: " + url.path}})
+
+# Start the mock server on a background thread, returns (server, state). Port 0 picks a free port
+def startServer(port=0, ranges=1000, addressSpaces=1, latency=0.0, errorRate=0.0, seed=1, capacity=None):
+  state = mockState(ranges, addressSpaces, latency=latency, errorRate=errorRate, seed=seed, capacity=capacity)
+  handler = type("boundMockHandler", (mockHandler,), {"state": state})
+  server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, state
+
+################################################################################
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Run a local stand-in for the Men and Mice REST api with synthetic ranges')
+  parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+  parser.add_argument('--ranges', type=int, default=10000, help='Ranges per address space (default: 10000)')
+  parser.add_argument('--address-spaces', type=int, default=1, help='Number of address spaces (default: 1)')
+  parser.add_argument('--latency', type=float, default=0.0, metavar='MS', help='Delay added to every request in milliseconds')
+  parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION', help='Fraction of requests answered with a 503')
+  parser.add_argument('--capacity', type=int, metavar='REQUESTS', help='Requests a second served before answering 429 Too Many Requests')
+  args = parser.parse_args(argv)
+
+  server, state = startServer(args.port, args.ranges, args.address_spaces, args.latency / 1000.0, args.error_rate, capacity=args.capacity)
+  print("Mock Men and Mice api on http://127.0.0.1:" + str(server.server_port) + " with " + str(args.address_spaces) + " address spaces of " + str(args.ranges) + " ranges, Ctrl+C to stop")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -4,37 +4,135 @@
 # 
 # Requirements:
 #   - needs python3 for .xlsx report
+#   - pandas and requests, imported where they are first needed so -h and argument errors return straight away
+#   - openpyxl for .xlsx output, pyarrow for .parquet output
 # 
 # For usage please execute: "$ python3 men_and_mice_report.py -h"
 #
 # Author: Western Wilson
 #
 import argparse
+import atexit
+import bisect
+import codecs
+import csv
 import getpass
+import gzip
+import hashlib
+import importlib.util
 import json
 import logging
-import pandas as pd
+import logging.handlers
+import os
+import queue
 import re
-import requests
+import socket
+import sqlite3
 import sys
+import threading
 import time
-import urllib3
-from urllib.parse import quote
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlparse
 from datetime import datetime
 
 ################################################################################
-# Logging methods to standardise how threaded logs are written to, reminds me how to format strings nicely with methods
+# Logging methods to standardise how threaded logs are written to. Messages take %s style arguments which
+# are only formatted if the record is written, and then on the listener thread set up by initLogging()
 def log_error(message, exception=None):
   if exception is None:
-    logging.error('FAILED at [{}] with no error message supplied'.format(message))
+    logging.error('FAILED at [%s] with no error message supplied', message)
   else:
-    logging.error('FAILED at [{}] error msg: {}'.format(message, exception))
+    logging.error('FAILED at [%s] error msg: %s', message, exception)
 
-def log_info(message):
-  logging.info('{}'.format(message))
+def log_info(message, *args):
+  logging.info(message, *args)
 
-def log_debug(message):
-  logging.debug('{}'.format(message))
+def log_debug(message, *args):
+  logging.debug(message, *args)
+
+# Hands records to the listener as they are, rather than formatting them on the logging thread first like
+# QueueHandler does. Anything passed as an argument must not be changed after it is logged
+class deferredQueueHandler(logging.handlers.QueueHandler):
+  def prepare(self, record):
+    return record
+
+# Short preview of a possibly huge response body for debug logs, with its full size.
+# Only worked out when the record is written, so it costs nothing with debug logging off
+class bodyPreview:
+  def __init__(self, data, limit=500):
+    self.data = data
+    self.limit = limit
+
+  def __str__(self):
+    data = self.data
+    size = len(data)
+    if isinstance(data, bytes):
+      data = data[:self.limit].decode('utf-8', errors='replace')
+    else:
+      data = data[:self.limit]
+    if size > self.limit:
+      data += '...'
+    return '(' + str(size) + ' bytes) ' + data
+
+################################################################################
+# Yield the elements of the first "key": [...] array in a json document that arrives as chunks of bytes.
+# Elements are decoded one at a time as the bytes come in, so only the element being parsed (and
+# whatever is left of the current chunk) is held in memory rather than the whole document
+def iterJsonArray(chunks, key):
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  chunks = iter(chunks)
+  marker = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+
+  # Find the start of the array, keeping a little of the previous text in case the key is split across chunks
+  buffer = ''
+  while True:
+    match = marker.search(buffer)
+    if match:
+      break
+    chunk = next(chunks, None)
+    if chunk is None:
+      raise ValueError('No "' + key + '" array in response')
+    buffer = buffer[-(len(key) + 64):] + utf8.decode(chunk)
+  buffer = buffer[match.end():]
+  position = 0
+
+  while True:
+    # Skip to the next element
+    while position < len(buffer) and buffer[position] in ' \t\r\n,':
+      position += 1
+    if position == len(buffer):
+      chunk = next(chunks, None)
+      if chunk is None:
+        raise ValueError('Response ended inside the "' + key + '" array')
+      buffer = utf8.decode(chunk)
+      position = 0
+      continue
+    if buffer[position] == ']':
+      return
+
+    try:
+      item, end = decoder.raw_decode(buffer, position)
+    except json.JSONDecodeError:
+      item, end = None, None
+    # An element that fails to decode or runs to the very end of the buffer may be cut off, read more first.
+    # So may a number that isn't followed by a separator yet, "2." decodes as 2 when the chunk ends there
+    complete = end is not None and end < len(buffer) and (buffer[position] in '{["' or buffer[end] in ' \t\r\n,]')
+    if not complete:
+      chunk = next(chunks, None)
+      if chunk is not None:
+        buffer = buffer[position:] + utf8.decode(chunk)
+        position = 0
+        continue
+      if end is None or end < len(buffer):
+        raise ValueError('Could not decode the "' + key + '" array in response')
+    yield item
+    position = end
+    # Drop what has been consumed now and then so the buffer doesn't grow with the response
+    if position > 65536:
+      buffer = buffer[position:]
+      position = 0
 
 ################################################################################
 # enum class for men & mice headers
@@ -50,42 +148,578 @@ class it:
     TO = "to"
     UTILIZATION_PERCENTAGE = "utilizationPercentage"
 
+################################################################################
+# On-disk cache of api results so repeated reports don't re-download everything
+class responseCache:
+  # Seconds each endpoint's results stay fresh, endpoints not listed are never cached
+  DEFAULT_TTLS = {
+    "GetCurrentAddressSpace": 60,
+    "AddressSpaces": 3600,
+    "Ranges": 900,
+  }
+
+  def __init__(self, directory, maxBytes=500 * 1024 * 1024, ttls=None):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.ttls = dict(responseCache.DEFAULT_TTLS)
+    if ttls:
+      self.ttls.update(ttls)
+    self.lock = threading.Lock()
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  # The endpoint name is the last part of the url path, e.g. Ranges or GetCurrentAddressSpace
+  def endpoint(url):
+    return urlparse(url).path.rstrip("/").split("/")[-1]
+
+  def ttlFor(self, url):
+    return self.ttls.get(responseCache.endpoint(url))
+
+  def pathFor(self, url, addressSpace):
+    key = hashlib.sha256((str(addressSpace) + " " + url).encode()).hexdigest()
+    return os.path.join(self.directory, key + ".json")
+
+  # Get the cached entry for a url in an address space or None, entry['fresh'] says if it is inside its ttl
+  def lookup(self, url, addressSpace):
+    ttl = self.ttlFor(url)
+    if ttl is None:
+      return None
+    path = self.pathFor(url, addressSpace)
+    try:
+      with open(path) as f:
+        entry = json.load(f)
+      # touch it so eviction drops the least recently used entries first
+      os.utime(path)
+    except (OSError, ValueError):
+      return None
+    entry['fresh'] = time.time() - entry['storedAt'] < ttl
+    return entry
+
+  # Conditional request headers so the server can answer 304 for an unchanged stale entry
+  def validators(entry):
+    headers = {}
+    if entry is None:
+      return headers
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('lastModified'):
+      headers['If-Modified-Since'] = entry['lastModified']
+    return headers
+
+  def store(self, url, addressSpace, result, responseHeaders=None, entry=None):
+    if self.ttlFor(url) is None:
+      return
+    responseHeaders = responseHeaders or {}
+    if entry is None:
+      entry = {
+        'url': url,
+        'addressSpace': addressSpace,
+        'etag': responseHeaders.get('ETag'),
+        'lastModified': responseHeaders.get('Last-Modified'),
+        'result': result,
+      }
+    entry.pop('fresh', None)
+    entry['storedAt'] = time.time()
+    path = self.pathFor(url, addressSpace)
+    # write to a temp file and swap it in so a concurrent run never reads half an entry
+    tempPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    with open(tempPath, "w") as f:
+      json.dump(entry, f)
+    os.replace(tempPath, path)
+    self.evict()
+
+  # The server said our stale entry is still current, restart its ttl
+  def refresh(self, entry):
+    self.store(entry['url'], entry['addressSpace'], entry['result'], entry=entry)
+
+  # Drop the least recently used entries until the cache fits in maxBytes
+  def evict(self):
+    with self.lock:
+      files = []
+      total = 0
+      for f in os.scandir(self.directory):
+        if f.name.endswith(".json"):
+          stat = f.stat()
+          files.append((stat.st_mtime, stat.st_size, f.path))
+          total += stat.st_size
+      if total <= self.maxBytes:
+        return
+      for mtime, size, path in sorted(files):
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        total -= size
+        if total <= self.maxBytes:
+          break
+
+################################################################################
+# Pages of ranges spilled to disk as they are fetched, so a report that dies halfway can be resumed without
+# fetching them again. One json lines file per address space: a header naming the address space and query,
+# a line per page, then a done line once the address space has been fetched in full. A torn last line
+# from a crash is dropped and that page is fetched again
+class pageSpill:
+  # Seconds between flushing the spill to disk, a crash loses at most this much fetching
+  FLUSH_INTERVAL = 5.0
+
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def pathFor(self, addressSpaceName):
+    return os.path.join(self.directory, hashlib.sha256(addressSpaceName.encode()).hexdigest()[:16] + ".jsonl")
+
+  def line(entry):
+    return (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+
+  # Pass the pages of an address space through, spilling each one. With resume the pages an earlier run
+  # spilled for the same query are replayed first and fetch(offset) only asked for the ranges after them
+  def pages(self, addressSpaceName, query, fetch, resume=False):
+    path = self.pathFor(addressSpaceName)
+    header = {"addressSpace": addressSpaceName, "query": query}
+    offset = 0
+    validBytes = 0
+    if resume and os.path.exists(path):
+      with open(path, "rb") as f:
+        first = f.readline()
+        try:
+          matches = first.endswith(b"\n") and json.loads(first) == header
+        except ValueError:
+          matches = False
+        if not matches:
+          log_info("Spilled pages for '" + addressSpaceName + "' are for a different query, fetching it again")
+        else:
+          validBytes = len(first)
+          for line in f:
+            if not line.endswith(b"\n"):
+              break
+            try:
+              entry = json.loads(line)
+            except ValueError:
+              break
+            if entry.get("done"):
+              log_info("Replayed all " + str(offset) + " spilled ranges for '" + addressSpaceName + "'")
+              return
+            validBytes += len(line)
+            offset += len(entry["ranges"])
+            yield entry["ranges"]
+
+    if validBytes:
+      if offset:
+        log_info("Resuming '" + addressSpaceName + "' after " + str(offset) + " spilled ranges")
+      spill = open(path, "r+b")
+      spill.truncate(validBytes)
+      spill.seek(validBytes)
+    else:
+      spill = open(path, "wb")
+      spill.write(pageSpill.line(header))
+    with spill:
+      lastFlush = time.monotonic()
+      for page in fetch(offset):
+        spill.write(pageSpill.line({"ranges": page}))
+        if time.monotonic() - lastFlush >= pageSpill.FLUSH_INTERVAL:
+          spill.flush()
+          os.fsync(spill.fileno())
+          lastFlush = time.monotonic()
+        yield page
+      spill.write(pageSpill.line({"done": True}))
+      spill.flush()
+      os.fsync(spill.fileno())
+
+  # Remove the spilled pages once the report they were for has been written
+  def clear(self):
+    for name in os.listdir(self.directory):
+      if name.endswith(".jsonl"):
+        os.remove(os.path.join(self.directory, name))
+    if not os.listdir(self.directory):
+      os.rmdir(self.directory)
+
+################################################################################
+# Run metrics: every api call (url template, status, latency, bytes, retries) and the time spent in each
+# phase of the report, written out as json or a Prometheus textfile at the end of the run
+class runMetrics:
+  PREFIX = "mm_report"
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.startTime = time.perf_counter()
+    # (method, url template, status) -> call stats
+    self.calls = {}
+    # phase -> [seconds, count]
+    self.phases = {}
+    self.cacheHits = 0
+
+  # The url with the server dropped, ids swapped for {id} and only the names of the query parameters,
+  # so calls to the same endpoint group together
+  def urlTemplate(url):
+    parsed = urlparse(url)
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', parsed.path)
+    params = sorted(set(param.split("=")[0] for param in parsed.query.split("&") if param))
+    if params:
+      path += "?" + "&".join(params)
+    return path
+
+  def recordCall(self, method, url, status, seconds, bytesReceived=0, retries=0):
+    key = (method, runMetrics.urlTemplate(url), str(status))
+    with self.lock:
+      stats = self.calls.get(key)
+      if stats is None:
+        stats = self.calls[key] = {'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'bytes': 0, 'retries': 0}
+      stats['count'] += 1
+      stats['seconds'] += seconds
+      stats['maxSeconds'] = max(stats['maxSeconds'], seconds)
+      stats['bytes'] += bytesReceived
+      stats['retries'] += retries
+
+  def recordCacheHit(self):
+    with self.lock:
+      self.cacheHits += 1
+
+  def addPhaseTime(self, name, seconds):
+    with self.lock:
+      phase = self.phases.setdefault(name, [0.0, 0])
+      phase[0] += seconds
+      phase[1] += 1
+
+  # Time a block of code as part of a phase, phases run by several workers add up
+  @contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addPhaseTime(name, time.perf_counter() - start)
+
+  # Pass through an iterator timing each step as part of a phase, e.g. waiting on the next page
+  def timedIter(self, iterable, name):
+    iterator = iter(iterable)
+    while True:
+      start = time.perf_counter()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        self.addPhaseTime(name, time.perf_counter() - start)
+        return
+      self.addPhaseTime(name, time.perf_counter() - start)
+      yield item
+
+  # Retries urllib3 made before handing back this response
+  def retriesOf(response):
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    return len(retries.history) if retries is not None and retries.history else 0
+
+  def summary(self):
+    with self.lock:
+      return {
+        'runSeconds': round(time.perf_counter() - self.startTime, 3),
+        'cacheHits': self.cacheHits,
+        'calls': [
+          dict(method=method, url=url, status=status, **stats)
+          for (method, url, status), stats in sorted(self.calls.items())
+        ],
+        'phases': dict((name, {'seconds': round(seconds, 3), 'count': count}) for name, (seconds, count) in sorted(self.phases.items())),
+      }
+
+  def promLabels(**labels):
+    escaped = []
+    for name, value in labels.items():
+      value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+      escaped.append(name + '="' + value + '"')
+    return "{" + ",".join(escaped) + "}"
+
+  def prometheusText(self):
+    summary = self.summary()
+    prefix = runMetrics.PREFIX
+    lines = [
+      "# HELP " + prefix + "_run_seconds Wall time of the report run",
+      "# TYPE " + prefix + "_run_seconds gauge",
+      prefix + "_run_seconds " + str(summary['runSeconds']),
+      "# HELP " + prefix + "_cache_hits_total Api calls answered from the response cache",
+      "# TYPE " + prefix + "_cache_hits_total counter",
+      prefix + "_cache_hits_total " + str(summary['cacheHits']),
+    ]
+    series = (
+      ('api_calls_total', 'counter', 'Api calls made', 'count'),
+      ('api_call_seconds_total', 'counter', 'Time spent in api calls', 'seconds'),
+      ('api_call_seconds_max', 'gauge', 'Slowest api call', 'maxSeconds'),
+      ('api_received_bytes_total', 'counter', 'Response bytes received', 'bytes'),
+      ('api_retries_total', 'counter', 'Retries before the final response', 'retries'),
+    )
+    for name, kind, help, key in series:
+      lines.append("# HELP " + prefix + "_" + name + " " + help)
+      lines.append("# TYPE " + prefix + "_" + name + " " + kind)
+      for call in summary['calls']:
+        labels = runMetrics.promLabels(method=call['method'], url=call['url'], status=call['status'])
+        lines.append(prefix + "_" + name + labels + " " + str(call[key]))
+    lines.append("# HELP " + prefix + "_phase_seconds_total Time spent in each phase of the report, summed over workers")
+    lines.append("# TYPE " + prefix + "_phase_seconds_total counter")
+    for name, phase in summary['phases'].items():
+      lines.append(prefix + "_phase_seconds_total" + runMetrics.promLabels(phase=name) + " " + str(phase['seconds']))
+    return "\n".join(lines) + "\n"
+
+  # Write the summary, a .prom file name gets the Prometheus textfile format and anything else json
+  def write(self, fileName):
+    if fileName.endswith('.prom'):
+      text = self.prometheusText()
+    else:
+      text = json.dumps(self.summary(), indent=2)
+    # swap the file in whole so a textfile collector never reads half of it
+    tempName = fileName + '.tmp'
+    with open(tempName, 'w') as f:
+      f.write(text)
+    os.replace(tempName, fileName)
+
+# Collected for every run, written out with --metrics
+metrics = runMetrics()
+
+################################################################################
+# Client side rate limit shared by every api call, a token bucket of rate calls a second holding a single
+# token, so calls are spaced out evenly rather than let through in bursts after a quiet spell. When
+# adaptive the rate is halved when the server struggles (a 429, 503 or failed call, urllib3 having to
+# retry, or an endpoint's latency climbing to latencyFactor times its usual) and creeps back up while it
+# keeps up, never going above maxRate
+class rateLimiter:
+  # The rate is multiplied by this when the server struggles
+  DECREASE = 0.5
+  # Fraction of maxRate added back per second of healthy responses
+  INCREASE = 0.05
+  # Weight of the newest call in an endpoint's average latency
+  SMOOTHING = 0.2
+  # Weight of the newest call in an endpoint's usual latency, far slower so jitter averages out of it
+  BASELINE_SMOOTHING = 0.02
+  # Seconds the average latency has to be above the usual before latency alone counts as struggling,
+  # so a few ms of jitter on a fast endpoint is never taken for congestion
+  MIN_LATENCY_RISE = 0.05
+  CONGESTED_STATUSES = ('error', 429, 503)
+
+  def __init__(self, maxRate, adaptive=False, minRate=0.5, latencyFactor=2.0):
+    self.maxRate = float(maxRate)
+    self.rate = self.maxRate
+    self.minRate = min(minRate, self.maxRate)
+    self.adaptive = adaptive
+    self.latencyFactor = latencyFactor
+    self.burst = 1.0
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lastDecrease = 0.0
+    # endpoint -> [average latency, usual latency]
+    self.latencies = {}
+    self.lock = threading.Lock()
+
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  # Wait for a token. It is taken under the lock and slept for outside it, so waiting calls queue up in order
+  def acquire(self):
+    with self.lock:
+      self.refill(time.monotonic())
+      self.tokens -= 1
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+  # Feed back how a call went, status is the http status or 'error' when there was no response
+  def observe(self, endpoint, seconds, status, retries=0):
+    if not self.adaptive:
+      return
+    with self.lock:
+      now = time.monotonic()
+      latency = self.latencies.get(endpoint)
+      if latency is None:
+        latency = self.latencies[endpoint] = [seconds, seconds]
+      else:
+        latency[0] += (seconds - latency[0]) * rateLimiter.SMOOTHING
+        # the usual latency is a slow average rather than the fastest call seen, so a server that is
+        # slower for good is eventually taken as it is
+        latency[1] += (seconds - latency[1]) * rateLimiter.BASELINE_SMOOTHING
+      slow = latency[0] > self.latencyFactor * latency[1] and latency[0] - latency[1] >= rateLimiter.MIN_LATENCY_RISE
+      congested = status in rateLimiter.CONGESTED_STATUSES or retries or slow
+      self.refill(now)
+      if congested:
+        # the calls already in flight were sent at the old rate and the average latency takes a few calls
+        # to come down, so give a decrease a second or two round trips to work before halving again
+        if now - self.lastDecrease < max(1.0, 2 * latency[0]):
+          return
+        self.lastDecrease = now
+        self.rate = max(self.minRate, self.rate * rateLimiter.DECREASE)
+        log_info('Server struggling on %s (status %s, %.3fs), rate limit lowered to %.2f calls/s', endpoint, status, latency[0], self.rate)
+      elif self.rate < self.maxRate:
+        self.rate = min(self.maxRate, self.rate + rateLimiter.INCREASE * self.maxRate / self.rate)
+
 ################################################################################
 # api wrapper class for easy api operations
 class api:
+  # Keep-alive sessions are per thread, the current address space is session state on the server
+  # so each worker needs its own session or they would switch address spaces under each other
+  _local = threading.local()
+  # Settings from the last openSession() call, reused when a new thread needs a session
+  sessionSettings = {}
+  # (connect, read) timeout in seconds for every call
+  timeout = (10, 300)
+  # responseCache used by getCall, None when caching is off
+  cache = None
+  # rateLimiter every call waits on, None for no limit
+  limiter = None
+  # Bytes read off the socket at a time when streaming a response
+  STREAM_CHUNK_SIZE = 65536
+  # Ranges handed on together when streaming
+  STREAM_BATCH = 1000
+  # Ranges pages fetched at once by getRangesPages() once the first page says how many there are
+  pageConcurrency = 1
+
+  # Build a pooled session for this thread with retries and exponential backoff on 429s, 5xx errors and
+  # connection resets
+  def openSession(poolSize=10, retries=3, backoff=0.5, timeout=None):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    api.sessionSettings = {'poolSize': poolSize, 'retries': retries, 'backoff': backoff}
+    session = requests.Session()
+    session.auth = (username, password)
+    session.verify = False
+    retry = Retry(
+      total=retries,
+      backoff_factor=backoff,
+      # a 429 or 503 with a Retry-After header waits as long as the server asks
+      status_forcelist=(429, 500, 502, 503, 504),
+      # hand back the last response once retries run out so the status handling below still applies
+      raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    api._local.session = session
+    api._local.addressSpace = None
+    if timeout is not None:
+      api.timeout = timeout
+    return session
+
+  # The session for the current thread, opened on first use
+  def getSession():
+    session = getattr(api._local, 'session', None)
+    if session is None:
+      session = api.openSession(**api.sessionSettings)
+    return session
+
+  # Close and forget the current thread's session
+  def closeSession():
+    session = getattr(api._local, 'session', None)
+    if session is not None:
+      session.close()
+      api._local.session = None
+
+  # The address space this thread's session is pointed at, part of the cache key
+  def currentAddressSpace():
+    return getattr(api._local, 'addressSpace', None)
+
+  # Wait for the rate limiter, when there is one, before calling the server
+  def throttle():
+    if api.limiter is not None:
+      api.limiter.acquire()
+
+  # Record a call in the metrics and tell the rate limiter how it went
+  def recordCall(method, url, status, seconds, bytesReceived=0, retries=0):
+    metrics.recordCall(method, url, status, seconds, bytesReceived, retries)
+    if api.limiter is not None:
+      api.limiter.observe(method + ' ' + runMetrics.urlTemplate(url), seconds, status, retries)
+
   # An API GET call
   def getCall(url):
+    # Serve from the cache when we can, a stale entry is revalidated with the server instead
+    entry = None
+    if api.cache is not None:
+      entry = api.cache.lookup(url, api.currentAddressSpace())
+      if entry is not None and entry['fresh']:
+        log_debug('Cache hit for url: %s', url)
+        metrics.recordCacheHit()
+        return entry['result']
+
+    api.throttle()
+    callStart = time.perf_counter()
     try:
-      myResponse = requests.get(url, auth=(username, password), verify=False)
+      myResponse = api.getSession().get(url, headers=responseCache.validators(entry), timeout=api.timeout)
     except:
+      api.recordCall('GET', url, 'error', time.perf_counter() - callStart)
       log_error('Failed get call for url: '+url)
       raise
+    api.recordCall('GET', url, myResponse.status_code, time.perf_counter() - callStart, len(myResponse.content), runMetrics.retriesOf(myResponse))
+
+    if myResponse.status_code == 304 and entry is not None:
+      log_debug('Cache revalidated for url: %s', url)
+      api.cache.refresh(entry)
+      return entry['result']
       
-    log_debug('Output from postCall:' + myResponse.text)
+    log_debug('Output from getCall: %s', bodyPreview(myResponse.content))
 
     if(myResponse.ok):
-      rawreply = myResponse.content
-      jNAData = json.loads(rawreply.decode())
+      # json.loads takes the bytes directly, no need for a decoded copy of the whole body
+      jNAData = json.loads(myResponse.content)
+      if api.cache is not None:
+        api.cache.store(url, api.currentAddressSpace(), jNAData['result'], myResponse.headers)
       return jNAData['result']
     elif myResponse.status_code == 404:
       log_error('API get call 404 Error!: '+url)
       exit()
     else:
       log_error('API get call other status code Error!: '+url)
+      jNAData = json.loads(myResponse.content)
       raise Exception(jNAData['error']['message'])
 
+  # An API GET call that yields the elements of the result's arrayKey array one at a time as the
+  # response is read, instead of loading the whole body. Streamed calls don't go through the cache
+  def getCallStream(url, arrayKey):
+    api.throttle()
+    callStart = time.perf_counter()
+    try:
+      myResponse = api.getSession().get(url, timeout=api.timeout, stream=True)
+    except:
+      api.recordCall('GET', url, 'error', time.perf_counter() - callStart)
+      log_error('Failed get call for url: '+url)
+      raise
+
+    # count the bytes as they stream past for the metrics
+    received = [0]
+    def countedChunks(chunks):
+      for chunk in chunks:
+        received[0] += len(chunk)
+        yield chunk
+
+    with myResponse:
+      log_debug('Streaming getCall: %s status %s content-length %s', url, myResponse.status_code, myResponse.headers.get('Content-Length'))
+      if myResponse.ok:
+        count = 0
+        for item in iterJsonArray(countedChunks(myResponse.iter_content(chunk_size=api.STREAM_CHUNK_SIZE)), arrayKey):
+          count += 1
+          yield item
+        api.recordCall('GET', url, myResponse.status_code, time.perf_counter() - callStart, received[0], runMetrics.retriesOf(myResponse))
+        log_debug('Streamed %s %s from: %s', count, arrayKey, url)
+      else:
+        api.recordCall('GET', url, myResponse.status_code, time.perf_counter() - callStart, len(myResponse.content), runMetrics.retriesOf(myResponse))
+        if myResponse.status_code == 404:
+          log_error('API get call 404 Error!: '+url)
+          exit()
+        log_error('API get call other status code Error!: '+url)
+        jNAData = json.loads(myResponse.content)
+        raise Exception(jNAData['error']['message'])
+
 # An API POST call
   def postCall(url,postData):
 
-    log_debug('Calling postData: '+postData)
+    log_debug('Calling postData: %s', bodyPreview(postData))
     
     headers = {'Content-type': 'application/json', 'Accept': '*/*'}
+    api.throttle()
+    callStart = time.perf_counter()
     try:
-      myResponse = requests.post(url, auth=(username, password), data=postData, headers=headers, verify=False)
+      myResponse = api.getSession().post(url, data=postData, headers=headers, timeout=api.timeout)
     except Exception as e:
+      api.recordCall('POST', url, 'error', time.perf_counter() - callStart)
       message = 'Failed post call for url: '+ str(url)
       log_error(message,e)
       exit()
+    api.recordCall('POST', url, myResponse.status_code, time.perf_counter() - callStart, len(myResponse.content), runMetrics.retriesOf(myResponse))
 
     # Chance this will be big
     # TODO: think if it should be included or not???
@@ -96,17 +730,49 @@ class api:
       if not rawreply:
         return True
       else:
-        jNAData = json.loads(rawreply.decode())
+        jNAData = json.loads(rawreply)
         return jNAData['result']
     elif myResponse.status_code == 404:
       log_error('API Error 404!')
       exit()
     else:
       rawreply = myResponse.content
-      jNAData = json.loads(rawreply.decode())
+      jNAData = json.loads(rawreply)
       log_error('API Error unknown header!')
       raise Exception(jNAData['error']['message'])
   
+  # Run call on every item with at most concurrency calls in flight. The results come back in input order
+  # as {'result': .., 'error': None} or {'result': None, 'error': message}, so one failed call is reported
+  # against its item instead of ending the whole batch. The workers share the caller's session, its
+  # current address space is server side session state and every call has to see the same one
+  def runMany(call, items, concurrency=None):
+    session = api.getSession()
+    addressSpace = api.currentAddressSpace()
+    if concurrency is None:
+      concurrency = api.sessionSettings.get('poolSize', 10)
+
+    def run(item):
+      api._local.session = session
+      api._local.addressSpace = addressSpace
+      try:
+        return {'result': call(item), 'error': None}
+      except SystemExit:
+        # getCall/postCall exit() on a 404 or a failed connection, it has already been logged
+        return {'result': None, 'error': 'API call failed, see the log'}
+      except Exception as e:
+        return {'result': None, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+      return list(executor.map(run, items))
+
+  # GET a list or iterator of urls concurrently, see runMany() for the results
+  def getMany(urls, concurrency=None):
+    return api.runMany(api.getCall, urls, concurrency)
+
+  # POST a list or iterator of (url, postData) pairs concurrently, see runMany() for the results
+  def postMany(calls, concurrency=None):
+    return api.runMany(lambda call: api.postCall(*call), calls, concurrency)
+
   ################################
   # Men & Mice specific API calls
 
@@ -131,6 +797,7 @@ class api:
       api.postCall(url,postData)
     except:
       raise
+    api._local.addressSpace = addressSpaceRef
     logging.info("Finishing setAddressSpace()")
   
   # Search for all addr spaces using id/name
@@ -156,12 +823,26 @@ class api:
     logging.info("Finishing getAddressSpaceFromUserInput("+userInput+")")
     return r
 
-  # Get all of the address ranges
-  def getRanges(limit=None):
+  # Get every address space on the server
+  def getAddressSpaces():
+    url="http://" + server + "/mmws/api/AddressSpaces"
+    try:
+      r = api.getCall(url)
+    except:
+      raise
+    return r['addressSpaces']
+
+  # Get all of the address ranges, query is extra url parameters such as a filter from rangesQuery()
+  def getRanges(limit=None, query=None):
     url="http://" + server + "/mmws/api/Ranges"
 
+    params = []
     if limit is not None:
-        url += "/?limit="+str(limit)
+        params.append("limit="+str(limit))
+    if query:
+        params.append(query)
+    if params:
+        url += "?" + "&".join(params)
 
     try:
         r = api.getCall(url)
@@ -169,11 +850,660 @@ class api:
         raise
     return r
 
+  # Walk the address ranges page by page using offset/limit, yields one list of ranges per page
+  # so the caller only ever holds a single page in memory. A pageSize of 0 fetches everything in one call.
+  # With stream the json is decoded a range at a time as it arrives and handed on in lists of at most
+  # STREAM_BATCH ranges, so even a single huge response never sits in memory whole. Starting at an offset
+  # skips the ranges before it, for carrying on from spilled pages
+  def getRangesPages(pageSize=1000, query=None, stream=False, offset=0):
+    if not pageSize and not stream and not offset:
+      yield api.getRanges(query=query)['ranges']
+      return
+
+    while True:
+      url="http://" + server + "/mmws/api/Ranges"
+      params = []
+      if pageSize:
+        params.append("limit=" + str(pageSize) + "&offset=" + str(offset))
+      elif offset:
+        params.append("offset=" + str(offset))
+      if query:
+        params.append(query)
+      if params:
+        url += "?" + "&".join(params)
+
+      if stream:
+        pageLength = 0
+        batch = []
+        for range in api.getCallStream(url, 'ranges'):
+          batch.append(range)
+          pageLength += 1
+          if len(batch) >= api.STREAM_BATCH:
+            yield batch
+            batch = []
+        if batch:
+          yield batch
+        totalResults = None
+      else:
+        try:
+          r = api.getCall(url)
+        except:
+          raise
+        page = r['ranges']
+        pageLength = len(page)
+        totalResults = r.get('totalResults')
+        if page:
+          yield page
+        # let the page go before fetching the next one
+        page = r = None
+
+      log_debug('Fetched ranges page offset=%s size=%s of %s', offset, pageLength, totalResults)
+      offset += pageLength
+      # Stop after a single request, on a short page, or once we have seen everything the server says it has
+      if not pageSize or pageLength < pageSize or (totalResults is not None and offset >= totalResults):
+        break
+      # The server has said how many there are, so the rest of the pages can be fetched concurrently
+      if api.pageConcurrency > 1 and totalResults is not None:
+        yield from api.getRangesPagesConcurrently(offset, totalResults, pageSize, query)
+        return
+
+  # The ranges pages from offset up to totalResults, fetched pageConcurrency pages at a time and
+  # still handed on one page at a time in order, so at most pageConcurrency pages are held at once
+  def getRangesPagesConcurrently(offset, totalResults, pageSize, query=None):
+    offsets = list(range(offset, totalResults, pageSize))
+    for start in range(0, len(offsets), api.pageConcurrency):
+      window = offsets[start:start + api.pageConcurrency]
+      urls = []
+      for pageOffset in window:
+        url = "http://" + server + "/mmws/api/Ranges?limit=" + str(pageSize) + "&offset=" + str(pageOffset)
+        if query:
+          url += "&" + query
+        urls.append(url)
+      for pageOffset, outcome in zip(window, api.getMany(urls, api.pageConcurrency)):
+        if outcome['error'] is not None:
+          raise Exception(outcome['error'])
+        page = outcome['result']['ranges']
+        log_debug('Fetched ranges page offset=%s size=%s of %s', pageOffset, len(page), totalResults)
+        if page:
+          yield page
+      page = outcome = None
+
+  # Build the extra Ranges url parameters: a filter= expression for the server to apply, in the same
+  # syntax getAddressSpaceFromUserInput uses, and a fields= list so only what we report on comes back
+  def rangesQuery(rangeFilter=None, fields=None):
+    params = []
+    if rangeFilter:
+      params.append("filter=" + quote(rangeFilter))
+    if fields:
+      params.append("fields=" + quote(",".join(fields)))
+    return "&".join(params)
+
+
+################################################################################
+# Range filters, pushed down to the server and re-applied to each page in case the server ignores them
+class rangeFilter:
+  # Terms in a filter expression are joined with this
+  JOINER = " and "
+  # Top level attributes the report needs, Title/Site Code/Description come from customProperties
+  FIELDS = (it.NAME, it.FROM, it.TO, it.IS_SUBNET, it.IS_CONTAINER, it.UTILIZATION_PERCENTAGE, it.CUSTOM_PROPS)
+
+  def __init__(self, minUtilisation=None, subnetsOnly=False, containersOnly=False, siteCode=None, namePattern=None):
+    self.minUtilisation = minUtilisation
+    self.subnetsOnly = subnetsOnly
+    self.containersOnly = containersOnly
+    self.siteCode = siteCode
+    self.namePattern = namePattern
+
+  def isEmpty(self):
+    return (self.minUtilisation is None and not self.subnetsOnly and not self.containersOnly
+      and self.siteCode is None and self.namePattern is None)
+
+  # The Men and Mice filter= expression for these options
+  def expression(self):
+    terms = []
+    if self.minUtilisation is not None:
+      terms.append(it.UTILIZATION_PERCENTAGE + ">=" + str(self.minUtilisation))
+    if self.subnetsOnly:
+      terms.append(it.IS_SUBNET + "=true")
+    if self.containersOnly:
+      terms.append(it.IS_CONTAINER + "=true")
+    if self.siteCode is not None:
+      terms.append("\"" + it.SITE_CODE + "\"=\"" + self.siteCode + "\"")
+    if self.namePattern is not None:
+      terms.append(it.NAME + "=@\"" + self.namePattern + "\"")
+    return rangeFilter.JOINER.join(terms)
+
+  # Apply the same filter to a page of the report with column-wise masks
+  def apply(self, df):
+    if self.isEmpty():
+      return df
+    import pandas as pd
+    mask = pd.Series(True, index=df.index)
+    if self.minUtilisation is not None:
+      mask &= pd.to_numeric(df[it.UTILIZATION_PERCENTAGE], errors='coerce') >= self.minUtilisation
+    if self.subnetsOnly:
+      mask &= df[it.IS_SUBNET].fillna(False).astype(bool)
+    if self.containersOnly:
+      mask &= df[it.IS_CONTAINER].fillna(False).astype(bool)
+    if self.siteCode is not None:
+      mask &= df['SiteCode'] == self.siteCode
+    if self.namePattern is not None:
+      mask &= df[it.NAME].str.contains(self.namePattern, case=False, regex=False, na=False)
+    return df[mask].reset_index(drop=True)
+
+################################################################################
+# Report writer, rows are appended a chunk at a time so the whole report never has to sit in memory.
+# xlsx uses a write-only workbook, csv and parquet write one file per sheet
+class reportWriter:
+  FORMATS = ("xlsx", "csv", "parquet")
+  # The sheet that keeps the plain output file name for csv and parquet
+  DEFAULT_SHEET = "ALL"
+  NO_SITE_CODE = "No Site Code"
+
+  def __init__(self, fileName, format=None, splitSites=False):
+    self.fileName = fileName
+    self.format = format or reportWriter.formatFor(fileName)
+    self.splitSites = splitSites
+    self.lock = threading.Lock()
+    self.workbook = None
+    # sheet name -> open worksheet, csv file or parquet writer
+    self.sheets = {}
+    self.usedSheetNames = set([reportWriter.DEFAULT_SHEET.lower()])
+    # (sheet, site code) -> site sheet name so each site sheet is named once
+    self.siteSheets = {}
+
+  # Pick the format from the file extension, defaults to xlsx
+  def formatFor(fileName):
+    extension = os.path.splitext(fileName)[1].lower().lstrip(".")
+    if extension in reportWriter.FORMATS:
+      return extension
+    return "xlsx"
+
+  # Check the libraries the format needs are around before any work is done, without importing them so the
+  # password prompt isn't kept waiting on openpyxl or pyarrow (and numpy through them)
+  def checkFormat(format):
+    library = {"parquet": "pyarrow", "xlsx": "openpyxl"}.get(format)
+    if library is not None and importlib.util.find_spec(library) is None:
+      raise ImportError(format.capitalize() + " output needs " + library + ", install it with 'pip install " + library + "'")
+
+  # Excel sheet names are max 31 chars, can't contain []:*?/\ and must be unique in the workbook. csv and
+  # parquet sheet names go into file names, so there everything but A-Za-z0-9._- is replaced before the
+  # names are made unique, otherwise "Space 1" and "Space_1" would both end up in ..._Space_1.csv
+  def sheetNameFor(self, name):
+    illegal = r'[\[\]:*?/\\]' if self.format == "xlsx" else r'[^A-Za-z0-9._-]'
+    with self.lock:
+      name = re.sub(illegal, '_', str(name))[:31] or 'AddressSpace'
+      candidate = name
+      count = 2
+      while candidate.lower() in self.usedSheetNames:
+        suffix = '_' + str(count)
+        candidate = name[:31 - len(suffix)] + suffix
+        count += 1
+      self.usedSheetNames.add(candidate.lower())
+      return candidate
+
+  # Append a chunk of rows to a sheet, with splitSites the rows also go to one sheet per SiteCode
+  # using a single groupby over the chunk
+  def write(self, sheetName, df, sitePrefix=""):
+    self.append(sheetName, df)
+    if not self.splitSites:
+      return
+    for siteCode, siteRows in df.groupby(df['SiteCode'].fillna(reportWriter.NO_SITE_CODE), sort=False):
+      key = (sheetName, siteCode)
+      if key not in self.siteSheets:
+        self.siteSheets[key] = self.sheetNameFor((sitePrefix + " " + str(siteCode)).strip())
+      self.append(self.siteSheets[key], siteRows)
+
+  def append(self, sheetName, df):
+    with self.lock:
+      if self.format == "xlsx":
+        self.appendXlsx(sheetName, df)
+      elif self.format == "csv":
+        self.appendCsv(sheetName, df)
+      else:
+        self.appendParquet(sheetName, df)
+
+  def appendXlsx(self, sheetName, df):
+    if self.workbook is None:
+      from openpyxl import Workbook
+      self.workbook = Workbook(write_only=True)
+    if sheetName not in self.sheets:
+      self.sheets[sheetName] = self.workbook.create_sheet(title=sheetName)
+      self.sheets[sheetName].append(list(df.columns))
+    sheet = self.sheets[sheetName]
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+      sheet.append(row)
+
+  # csv and parquet write a file per sheet, the default sheet keeps the given file name. sheetNameFor has
+  # already made the names safe and unique as file names
+  def pathFor(self, sheetName):
+    if sheetName == reportWriter.DEFAULT_SHEET:
+      return self.fileName
+    stem, extension = os.path.splitext(self.fileName)
+    return stem + "_" + sheetName + extension
+
+  def appendCsv(self, sheetName, df):
+    first = sheetName not in self.sheets
+    if first:
+      self.sheets[sheetName] = open(self.pathFor(sheetName), "w", newline="", encoding="utf-8")
+    df.to_csv(self.sheets[sheetName], header=first, index=False)
+
+  def appendParquet(self, sheetName, df):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if sheetName not in self.sheets:
+      # Pin the report column types so a chunk with an all blank column still matches the first chunk
+      fields = []
+      for column in df.columns:
+        if column == it.UTILIZATION_PERCENTAGE:
+          fields.append(pa.field(column, pa.float64()))
+        elif column in (it.IS_SUBNET, it.IS_CONTAINER):
+          fields.append(pa.field(column, pa.bool_()))
+        elif column in TEXT_COLUMNS:
+          fields.append(pa.field(column, pa.string()))
+        elif column in ROLLUP_PARQUET_TYPES:
+          fields.append(pa.field(column, pa.type_for_alias(ROLLUP_PARQUET_TYPES[column])))
+        else:
+          fields.append(pa.Schema.from_pandas(df[[column]], preserve_index=False).field(column))
+      schema = pa.schema(fields)
+      self.sheets[sheetName] = (pq.ParquetWriter(self.pathFor(sheetName), schema), schema)
+    parquetWriter, schema = self.sheets[sheetName]
+    parquetWriter.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+  # True once anything has been written
+  def hasOutput(self):
+    return bool(self.sheets)
+
+  def close(self):
+    with self.lock:
+      if self.format == "xlsx":
+        if self.workbook is not None:
+          self.workbook.save(self.fileName)
+      elif self.format == "csv":
+        for f in self.sheets.values():
+          f.close()
+      else:
+        for parquetWriter, schema in self.sheets.values():
+          parquetWriter.close()
+
+################################################################################
+# Sorted, bisect searchable index of range boundaries answering "which range holds this IP" without the server.
+# Per address space the entries are [ip version, from, to, parent, name, from text, to text, SiteCode, Title]
+# sorted by (version, from, widest first), parent being the index of the entry holding it
+class rangeIndex:
+  SNAPSHOT_VERSION = 1
+  COLUMNS = ('ipVersion', 'fromInt', 'toInt', 'parent', it.NAME, it.FROM, it.TO, 'SiteCode', it.TITLE)
+  # Report columns each range carries into the index
+  FRAME_COLUMNS = (it.NAME, it.FROM, it.TO, 'SiteCode', it.TITLE)
+
+  def __init__(self, addressSpaces=None):
+    # address space name -> (keys, entries), keys being the (version, from) of each entry for bisect
+    self.addressSpaces = {}
+    self.lock = threading.Lock()
+    for addressSpace, entries in (addressSpaces or {}).items():
+      self.addressSpaces[addressSpace] = ([(entry[0], entry[1]) for entry in entries], entries)
+
+  # Add (or replace) the ranges of one address space from report rows
+  def add(self, addressSpace, df):
+    df = df.astype(object).where(df.notna(), None)
+    bounds, order, parent, depth = findParents(df[it.FROM].tolist(), df[it.TO].tolist())
+    rows = list(zip(*[df[column].tolist() for column in rangeIndex.FRAME_COLUMNS]))
+    position = dict((i, n) for n, i in enumerate(order))
+    entries = []
+    for i in order:
+      version, start, end = bounds[i]
+      entries.append([version, start, end, position.get(parent[i])] + list(rows[i]))
+    with self.lock:
+      self.addressSpaces[addressSpace] = ([(entry[0], entry[1]) for entry in entries], entries)
+
+  def rangeCount(self):
+    return sum(len(entries) for keys, entries in self.addressSpaces.values())
+
+  # The innermost range holding the address in each address space, as dicts of COLUMNS plus addressSpace.
+  # Bisect finds the last range starting at or before the address, the innermost range holding the
+  # address is either that one or one of its parents
+  def lookup(self, address):
+    parsed = parseAddress(address.strip())
+    if parsed is None:
+      raise ValueError("'" + address + "' is not an IP address")
+    version, number = parsed
+    matches = []
+    for addressSpace, (keys, entries) in self.addressSpaces.items():
+      n = bisect.bisect_right(keys, (version, number)) - 1
+      while n is not None and n >= 0:
+        entry = entries[n]
+        if entry[0] != version:
+          break
+        if entry[1] <= number <= entry[2]:
+          match = dict(zip(rangeIndex.COLUMNS, entry))
+          match['addressSpace'] = addressSpace
+          matches.append(match)
+          break
+        n = entry[3]
+    return matches
+
+  def open(fileName, mode, compressed):
+    if compressed:
+      return gzip.open(fileName, mode + 't', encoding='utf-8')
+    return open(fileName, mode, encoding='utf-8')
+
+  # Save a snapshot, a .gz file name is gzipped
+  def save(self, fileName):
+    with self.lock:
+      snapshot = {
+        'version': rangeIndex.SNAPSHOT_VERSION,
+        'createdAt': datetime.now().isoformat(),
+        'columns': rangeIndex.COLUMNS,
+        'addressSpaces': dict((addressSpace, entries) for addressSpace, (keys, entries) in self.addressSpaces.items()),
+      }
+      tempName = fileName + '.tmp'
+      with rangeIndex.open(tempName, 'w', fileName.endswith('.gz')) as f:
+        json.dump(snapshot, f)
+      os.replace(tempName, fileName)
+
+  def load(fileName):
+    with rangeIndex.open(fileName, 'r', fileName.endswith('.gz')) as f:
+      snapshot = json.load(f)
+    if snapshot.get('version') != rangeIndex.SNAPSHOT_VERSION:
+      raise ValueError("Index snapshot '" + fileName + "' is from a different version of this script, rebuild it")
+    index = rangeIndex(snapshot['addressSpaces'])
+    log_info("Loaded range index '" + fileName + "' created " + snapshot['createdAt'] + " with " + str(index.rangeCount()) + " ranges")
+    return index
+
+################################################################################
+# History of every run's ranges in a local SQLite database, so runs can be compared with indexed queries
+# instead of diffing old reports. One runs row per address space per run along with the ranges query it
+# was filtered by, the ranges of a run are keyed by (run, from, to, name) so comparing two runs is a
+# primary key lookup per range
+class historyStore:
+  SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    " run_id INTEGER PRIMARY KEY,"
+    " address_space TEXT NOT NULL,"
+    " taken_at TEXT NOT NULL,"
+    " complete INTEGER NOT NULL DEFAULT 0,"
+    " query TEXT)",
+    "CREATE INDEX IF NOT EXISTS runs_by_space ON runs (address_space, complete, run_id)",
+    "CREATE TABLE IF NOT EXISTS ranges ("
+    " run_id INTEGER NOT NULL REFERENCES runs (run_id),"
+    " range_from TEXT NOT NULL,"
+    " range_to TEXT NOT NULL,"
+    " name TEXT NOT NULL,"
+    " title TEXT,"
+    " site_code TEXT,"
+    " description TEXT,"
+    " utilization REAL,"
+    " subnet INTEGER,"
+    " is_container INTEGER,"
+    " PRIMARY KEY (run_id, range_from, range_to, name)) WITHOUT ROWID",
+  )
+  # Report columns in the order of the ranges table columns after run_id
+  COLUMNS = (it.FROM, it.TO, it.NAME, it.TITLE, 'SiteCode', it.DESCRIPTION, it.UTILIZATION_PERCENTAGE, it.IS_SUBNET, it.IS_CONTAINER)
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    # one connection shared by the workers, the lock keeps them from interleaving statements
+    self.connection = sqlite3.connect(fileName, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock:
+      for statement in historyStore.SCHEMA:
+        self.connection.execute(statement)
+      # databases from before the query was kept, their runs have a null query and only compare with each other
+      if 'query' not in [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]:
+        self.connection.execute("ALTER TABLE runs ADD COLUMN query TEXT")
+      self.connection.commit()
+
+  # Start a run for an address space fetched with the ranges query, returns its run id
+  def startRun(self, addressSpace, query):
+    with self.lock:
+      cursor = self.connection.execute("INSERT INTO runs (address_space, taken_at, query) VALUES (?, ?, ?)", (addressSpace, datetime.now().isoformat(timespec='seconds'), query))
+      self.connection.commit()
+      return cursor.lastrowid
+
+  # Store a page of report rows for a run
+  def addRanges(self, runId, df):
+    df = df.astype(object).where(df.notna(), None)
+    rows = []
+    for values in zip(*[df[column].tolist() for column in historyStore.COLUMNS]):
+      values = list(values)
+      # the key columns can't be null, a missing from/to/name is stored as blank
+      for n in range(3):
+        if values[n] is None:
+          values[n] = ''
+      for n in (7, 8):
+        if values[n] is not None:
+          values[n] = int(bool(values[n]))
+      rows.append([runId] + values)
+    with self.lock:
+      self.connection.executemany("INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+  # Only complete runs are compared, so a run that died half way isn't mistaken for deleted ranges
+  def finishRun(self, runId):
+    with self.lock:
+      self.connection.execute("UPDATE runs SET complete = 1 WHERE run_id = ?", (runId,))
+      self.connection.commit()
+
+  def addressSpaces(self):
+    with self.lock:
+      return [row[0] for row in self.connection.execute("SELECT DISTINCT address_space FROM runs WHERE complete = 1 ORDER BY address_space")]
+
+  # The last two complete runs of an address space as (previous, latest), either may be None. Only the
+  # ranges that passed a run's filter are stored, so previous is the last run with the same query as latest
+  def lastTwoRuns(self, addressSpace):
+    with self.lock:
+      latest = self.connection.execute(
+        "SELECT run_id, taken_at, query FROM runs WHERE address_space = ? AND complete = 1 ORDER BY run_id DESC LIMIT 1",
+        (addressSpace,)).fetchone()
+      if latest is None:
+        return None, None
+      previous = self.connection.execute(
+        "SELECT run_id, taken_at FROM runs WHERE address_space = ? AND complete = 1 AND query IS ? AND run_id < ? ORDER BY run_id DESC LIMIT 1",
+        (addressSpace, latest[2], latest[0])).fetchone()
+    return previous, latest[:2]
+
+  # Changes between two runs as tuples of
+  # (change, name, from, to, previous utilization, utilization, SiteCode, Title)
+  # change is 'appeared', 'disappeared', 'crossed threshold' or 'grew'
+  def diff(self, previousRun, latestRun, threshold=None, growth=None):
+    queries = [
+      ("SELECT 'appeared', c.name, c.range_from, c.range_to, NULL, c.utilization, c.site_code, c.title"
+       " FROM ranges c WHERE c.run_id = ? AND NOT EXISTS (SELECT 1 FROM ranges p WHERE p.run_id = ?"
+       " AND p.range_from = c.range_from AND p.range_to = c.range_to AND p.name = c.name)",
+       (latestRun, previousRun)),
+      ("SELECT 'disappeared', p.name, p.range_from, p.range_to, p.utilization, NULL, p.site_code, p.title"
+       " FROM ranges p WHERE p.run_id = ? AND NOT EXISTS (SELECT 1 FROM ranges c WHERE c.run_id = ?"
+       " AND c.range_from = p.range_from AND c.range_to = p.range_to AND c.name = p.name)",
+       (previousRun, latestRun)),
+    ]
+    matched = ("FROM ranges c JOIN ranges p ON p.run_id = ? AND p.range_from = c.range_from"
+      " AND p.range_to = c.range_to AND p.name = c.name WHERE c.run_id = ?")
+    if threshold is not None:
+      queries.append((
+        "SELECT 'crossed threshold', c.name, c.range_from, c.range_to, p.utilization, c.utilization, c.site_code, c.title "
+        + matched + " AND c.utilization >= ? AND (p.utilization IS NULL OR p.utilization < ?)",
+        (previousRun, latestRun, threshold, threshold)))
+    if growth is not None:
+      queries.append((
+        "SELECT 'grew', c.name, c.range_from, c.range_to, p.utilization, c.utilization, c.site_code, c.title "
+        + matched + " AND c.utilization - p.utilization >= ?",
+        (previousRun, latestRun, growth)))
+    changes = []
+    with self.lock:
+      for sql, params in queries:
+        changes += self.connection.execute(sql, params).fetchall()
+    return changes
+
+  def close(self):
+    with self.lock:
+      self.connection.commit()
+      self.connection.close()
 
 ################################################################################
 # Main methods to compartmentalise the script
 
+# Report columns in the order they are written out
+REPORT_COLUMNS = (
+  it.NAME, it.TITLE, 'SiteCode',
+  it.DESCRIPTION, it.UTILIZATION_PERCENTAGE,
+  it.FROM,it.TO,it.IS_SUBNET,
+  it.IS_CONTAINER
+)
+
+# Columns that can hold free text and so may need illegal characters escaped
+TEXT_COLUMNS = (it.NAME, it.TITLE, 'SiteCode', it.DESCRIPTION, it.FROM, it.TO)
+
+# Project a page of ranges from the api straight into report columns, one list per column
+# rather than one dict per range. Missing attributes come through as blanks
+def rangesToFrame(ranges):
+  import pandas as pd
+  customProperties = [range.get(it.CUSTOM_PROPS) or {} for range in ranges]
+  columns = {
+    it.NAME: [range.get(it.NAME) for range in ranges],
+    it.TITLE: [props.get(it.TITLE) for props in customProperties],
+    'SiteCode': [props.get(it.SITE_CODE) for props in customProperties],
+    it.DESCRIPTION: [props.get(it.DESCRIPTION) for props in customProperties],
+    it.UTILIZATION_PERCENTAGE: [range.get(it.UTILIZATION_PERCENTAGE) for range in ranges],
+    it.FROM: [range.get(it.FROM) for range in ranges],
+    it.TO: [range.get(it.TO) for range in ranges],
+    it.IS_SUBNET: [range.get(it.IS_SUBNET) for range in ranges],
+    it.IS_CONTAINER: [range.get(it.IS_CONTAINER) for range in ranges],
+  }
+  return pd.DataFrame(columns, columns=REPORT_COLUMNS)
+
+# Used to fix a bug with illegal characters in the xlsx, escapes the text columns a column at a time.
+# Only strings with a backslash or something outside printable ascii change when unicode escaped,
+# so a column that is clean as one joined string is skipped and otherwise only those cells are re-encoded
+def escapeIllegalCharacters(df):
+  import pandas as pd
+  for column in TEXT_COLUMNS:
+    series = df[column]
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+      continue
+    values = series.dropna().to_numpy(dtype=object)
+    try:
+      joined = "".join(values)
+    except TypeError:
+      # mixed column, only the strings need checking
+      joined = "".join([value for value in values if isinstance(value, str)])
+    if joined.isascii() and joined.isprintable() and "\\" not in joined:
+      continue
+    needsEscape = series.str.contains(r'[^\x20-\x7e]|\\', regex=True, na=False)
+    series = series.astype(object)
+    series[needsEscape] = series[needsEscape].str.encode('unicode_escape').str.decode('utf-8')
+    df[column] = series
+  return df
+
+# Columns added to the report by buildContainmentTree()
+ROLLUP_COLUMNS = ('parentRange', 'depth', 'childCount', 'freeAddresses', 'rolledUpUtilization')
+# Their parquet types, pinned like the report columns so every chunk and sheet matches
+ROLLUP_PARQUET_TYPES = {
+  'parentRange': 'string',
+  'depth': 'int64',
+  'childCount': 'int64',
+  'freeAddresses': 'string',
+  'rolledUpUtilization': 'float64',
+}
+
+# Parse an IPv4/IPv6 address into (version, integer) so ranges can be compared numerically,
+# None when it isn't an address
+def parseAddress(address):
+  if not isinstance(address, str):
+    return None
+  try:
+    if ':' in address:
+      return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+  except OSError:
+    return None
+
+# Sort ranges by (version, from, widest first) so a parent always comes before what it holds, then one
+# sweep with a stack of open ranges finds each range's parent. Returns
+#   bounds  (version, from, to) integers per range, None when from/to aren't addresses
+#   order   indexes of the parsed ranges in sorted order
+#   parent  index of the smallest range holding each range, or None
+#   depth   0 for top level ranges
+def findParents(froms, tos):
+  count = len(froms)
+  bounds = [None] * count
+  for i, (start, end) in enumerate(zip(froms, tos)):
+    start = parseAddress(start)
+    end = parseAddress(end)
+    if start is not None and end is not None and start[0] == end[0]:
+      bounds[i] = (start[0], start[1], end[1])
+  order = sorted((i for i in range(count) if bounds[i] is not None), key=lambda i: (bounds[i][0], bounds[i][1], -bounds[i][2]))
+
+  parent = [None] * count
+  depth = [0] * count
+  stack = []
+  for i in order:
+    version, start, end = bounds[i]
+    # close the ranges that end before this one starts
+    while stack and (bounds[stack[-1]][0] != version or bounds[stack[-1]][2] < start):
+      stack.pop()
+    # the innermost open range that holds all of this one is its parent, a range that only
+    # partly overlaps isn't a parent
+    for candidate in reversed(stack):
+      if bounds[candidate][2] >= end:
+        parent[i] = candidate
+        depth[i] = depth[candidate] + 1
+        break
+    stack.append(i)
+  return bounds, order, parent, depth
+
+# Rebuild the container -> subnet hierarchy from the from/to of every range and roll utilisation up it.
+# findParents() sorts once, then a reverse sweep over the sorted ranges sums the children into their
+# parents, O(n log n) overall. Adds ROLLUP_COLUMNS:
+#   parentRange          name of the smallest range holding this one
+#   depth                0 for top level ranges
+#   childCount           ranges directly inside a container
+#   freeAddresses        addresses in a container not covered by any of its children
+#   rolledUpUtilization  utilisation of a container from the subnets under it, weighted by subnet size
+def buildContainmentTree(df):
+  import pandas as pd
+  count = len(df)
+  bounds, order, parent, depth = findParents(df[it.FROM].tolist(), df[it.TO].tolist())
+
+  utilization = pd.to_numeric(df[it.UTILIZATION_PERCENTAGE], errors='coerce').tolist()
+  isSubnet = df[it.IS_SUBNET].fillna(False).astype(bool).tolist()
+  isContainer = df[it.IS_CONTAINER].fillna(False).astype(bool).tolist()
+  childCount = [0] * count
+  coveredAddresses = [0] * count
+  usedAddresses = [0.0] * count
+  # children come after their parents in the sort, so walking it backwards finishes every child first
+  for i in reversed(order):
+    version, start, end = bounds[i]
+    size = end - start + 1
+    if isSubnet[i] and utilization[i] == utilization[i]:
+      usedAddresses[i] = size * utilization[i] / 100.0
+    p = parent[i]
+    if p is not None:
+      childCount[p] += 1
+      coveredAddresses[p] += size
+      usedAddresses[p] += usedAddresses[i]
+
+  names = df[it.NAME].tolist()
+  parentRange = [names[p] if p is not None else None for p in parent]
+  freeAddresses = [None] * count
+  rolledUpUtilization = [None] * count
+  for i in order:
+    if isContainer[i]:
+      version, start, end = bounds[i]
+      size = end - start + 1
+      freeAddresses[i] = size - coveredAddresses[i]
+      rolledUpUtilization[i] = round(usedAddresses[i] * 100.0 / size, 2)
+
+  df = df.copy()
+  df['parentRange'] = parentRange
+  df['depth'] = [depth[i] if bounds[i] is not None else None for i in range(count)]
+  df['childCount'] = [childCount[i] if isContainer[i] else None for i in range(count)]
+  # free space in an IPv6 container can be bigger than a float or int64 holds exactly, so the column is
+  # text for every container and has the one type when written out
+  df['freeAddresses'] = [None if free is None else str(free) for free in freeAddresses]
+  df['rolledUpUtilization'] = rolledUpUtilization
+  return df
+
 # Selects an address space from the user input, function used to keep main clean
+# Returns the name of the selected address space, raises if it can't be found or set
 def selectAddressSpaceFromUserInput(userInput):
   logging.info("Starting selectAddressSpaceFromUserInput("+userInput+")")
   try:
@@ -183,12 +1513,14 @@ def selectAddressSpaceFromUserInput(userInput):
     # Get the new intended address space and name
     currentAddressSpace = api.getAddressSpaceFromUserInput(currAddrSpaceID)
     currAddrSpaceName = currentAddressSpace['addressSpaces'][0]['name']
+    selectedName = currAddrSpaceName
 
     # Set newAddressSpace as None so if its not set we can fallout gracefully
     newAddressSpace = None
     # Check if the currAddrSpace matches, if it doesn't then try find a match
     if userInput.isdigit():
       if currAddrSpaceID == userInput:
+        api._local.addressSpace = currentAddressSpace['addressSpaces'][0]['ref']
         logging.info("Current address space is already selected: {"+str(currAddrSpaceID)+" : "+str(currAddrSpaceName)+"}")
       else:
         newAddressSpace = api.getAddressSpaceFromUserInput(userInput)
@@ -201,19 +1533,142 @@ def selectAddressSpaceFromUserInput(userInput):
             newAddressSpaceID = newAddressSpace['addressSpaces'][0]['ref']
             # Set the new adress space
             api.setAddressSpace(newAddressSpaceID)
+            selectedName = newAddressSpace['addressSpaces'][0]['name']
             logging.info("Address space updated successfully: {"+str(newAddressSpace['addressSpaces'][0])+"}")
             # TODO: Add a way for user to select from list of multiple address spaces if more than one return
         else:
-            logging.info("Address space not found for user input: '" + userInput+"', please try another input")
-            quit()
+            raise LookupError("Address space not found for user input: '" + userInput+"', please try another input")
   except Exception as e:
       log_error("selectAddressSpaceFromUserInput('"+userInput+"')",e)
-      quit()
+      raise
 
   logging.info("Finishing selectAddressSpaceFromUserInput("+userInput+")")
+  return selectedName
+
+# Expand the -a values into a list of address space inputs, "all" means every address space on the server
+def expandAddressSpaceInputs(values):
+  inputs = []
+  for value in values:
+    inputs += [v.strip() for v in value.split(",") if v.strip()]
+  if any(v.lower() == "all" for v in inputs):
+    inputs = [a['ref'].split("/")[1] for a in api.getAddressSpaces()]
+    log_info("Reporting on all "+str(len(inputs))+" address spaces")
+  return inputs
+
+# Fetch one address space and stream its ranges into the report writer, run by the worker pool
+# Each call gets its own session so the SetCurrentAddressSpace of one worker can't leak into another
+# With an index the address space's ranges are also added to it, with no writer they only go to the index
+# Returns the address space name and the number of ranges fetched
+def buildAddressSpaceReport(userInput, writer, sheetName=None, index=None):
+  import pandas as pd
+  api.openSession(**api.sessionSettings)
+  try:
+    with metrics.phase('select'):
+      addressSpaceName = selectAddressSpaceFromUserInput(userInput)
+    query = api.rangesQuery(range_filter.expression(), rangeFilter.FIELDS)
+    runId = history.startRun(addressSpaceName, query) if history is not None else None
+    if writer is not None and sheetName is None:
+      sheetName = writer.sheetNameFor(addressSpaceName)
+    sitePrefix = "" if sheetName == reportWriter.DEFAULT_SHEET else addressSpaceName
+
+    # Build the ranges report one page at a time, each page is projected into a data frame
+    # and written out straight away so the report never has to sit in memory
+    # The roll up needs every range of the address space at once, so then the pages are held until the end
+    rowCount = 0
+    heldFrames = []
+    indexFrames = []
+    log_info('Starting looping through ranges for '+addressSpaceName)
+    pages = api.getRangesPages(page_size, query, stream=stream_json)
+    if page_spill is not None:
+      pages = page_spill.pages(addressSpaceName, query, lambda offset: api.getRangesPages(page_size, query, stream=stream_json, offset=offset), resume)
+    for page in metrics.timedIter(pages, 'fetch'):
+      with metrics.phase('transform'):
+        df = range_filter.apply(rangesToFrame(page))
+      with metrics.phase('sanitize'):
+        df = escapeIllegalCharacters(df)
+      if index is not None:
+        indexFrames.append(df[list(rangeIndex.FRAME_COLUMNS)])
+      if runId is not None:
+        with metrics.phase('history'):
+          history.addRanges(runId, df)
+      if writer is None:
+        pass
+      elif rollup:
+        heldFrames.append(df)
+      else:
+        with metrics.phase('write'):
+          writer.write(sheetName, df, sitePrefix)
+      rowCount += len(df)
+    log_info('Finished looping through ranges for '+addressSpaceName)
+    if runId is not None:
+      history.finishRun(runId)
+
+    if index is not None:
+      with metrics.phase('index'):
+        index.add(addressSpaceName, pd.concat(indexFrames, ignore_index=True) if indexFrames else rangesToFrame([]))
+      indexFrames = None
+
+    if writer is None:
+      pass
+    elif rollup:
+      log_info('Building containment tree for '+addressSpaceName)
+      df = pd.concat(heldFrames, ignore_index=True) if heldFrames else rangesToFrame([])
+      heldFrames = None
+      with metrics.phase('rollup'):
+        df = buildContainmentTree(df)
+      with metrics.phase('write'):
+        writer.write(sheetName, df, sitePrefix)
+    elif rowCount == 0:
+      # still write the header so the address space shows up in the report
+      writer.write(sheetName, rangesToFrame([]), sitePrefix)
+  finally:
+    api.closeSession()
+
+  return addressSpaceName, rowCount
+
+# Fetch the address spaces concurrently with the worker pool, each worker uses its own session
+# A failed address space is logged and skipped, returns how many succeeded
+def runAddressSpaces(addressSpaceInputs, writer, sheetName=None, index=None):
+  succeeded = 0
+  with ThreadPoolExecutor(max_workers=min(workers, max(1, len(addressSpaceInputs)))) as executor:
+    futures = [executor.submit(buildAddressSpaceReport, userInput, writer, sheetName, index) for userInput in addressSpaceInputs]
+    for userInput, future in zip(addressSpaceInputs, futures):
+      try:
+        addressSpaceName, rowCount = future.result()
+        log_info("Fetched "+str(rowCount)+" ranges for address space '"+addressSpaceName+"'")
+        succeeded += 1
+      except (Exception, SystemExit) as e:
+        log_error("Fetching address space '"+userInput+"', its output may be missing or incomplete", e)
+        print("Skipping address space '"+userInput+"', check the logs for more...")
+  return succeeded
 
 ################################################################################
 
+# The password comes from MM_PASSWORD when it is set so scheduled runs don't need a terminal, otherwise it is
+# prompted for
+def readPassword():
+  return os.environ.get("MM_PASSWORD") or getpass.getpass(prompt='Password:')
+
+# Records are queued by whichever thread logs them and written to ./logs/output.log by a listener thread,
+# so the api workers never wait on the log file or on each other to log
+def initLogging():
+  if not os.path.exists('./logs'):
+    os.makedirs('./logs')
+
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+  if any(isinstance(handler, deferredQueueHandler) for handler in root.handlers):
+    return
+
+  fileHandler = logging.FileHandler('./logs/output.log', mode='a')
+  fileHandler.setFormatter(logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt="%Y-%m-%d %H:%M:%S"))
+  records = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(records, fileHandler)
+  listener.start()
+  # write out whatever is still queued when the script exits, however it exits
+  atexit.register(listener.stop)
+  root.addHandler(deferredQueueHandler(records))
+
 def init(argv):
   # global variables so we don't have to pass them everywhere
   global username
@@ -221,22 +1676,26 @@ def init(argv):
   global start_time
   global server
   global address_space
+  global page_size
+  global stream_json
+  global workers
+  global report_file_name
+  global report_format
+  global split_sites
+  global rollup
+  global index_file_name
+  global metrics_file_name
+  global range_index
+  global history
+  global range_filter
+  global page_spill
+  global resume
 
   # Set debug to False by default
   global debug
   debug = False
 
-  # Setup the logger
-  logging.basicConfig(
-    filename='./logs/output.log',
-    filemode='a',
-    # encoding='utf-8', # This does not work
-    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.INFO
-  )
-  # Set the logger again as sometimes it keeps debug mode ???
-  logging.getLogger().setLevel(logging.INFO)
+  initLogging()
 
   start_time = datetime.now()
   
@@ -244,10 +1703,39 @@ def init(argv):
   logging.info("***START SCRIPT***")
 
   # Check the command line parameters are good:
-  parser = argparse.ArgumentParser(description='Provide a list of devices in a file with your M&M_USERNAME and we\'ll return build a report')
+  parser = argparse.ArgumentParser(description='Provide a list of devices in a file with your M&M_USERNAME and we\'ll return build a report',
+    epilog="Other modes: 'men_and_mice_report.py query' looks up which range IP addresses belong to from a --save-index snapshot, "
+      "'men_and_mice_report.py diff' reports what changed between the last two --history runs. Pass -h after the mode for its options")
   parser.add_argument('-s', required=True, metavar='HOSTNAME', help='M&M server hostname or IP address')
-  parser.add_argument('-u', required=True, metavar='USERNAME', help='M&M username')
-  parser.add_argument('-a', required=True, metavar="ADDRESS_SPACE", help="Address Space ID or Name")
+  parser.add_argument('-u', required=True, metavar='USERNAME', help='M&M username, the password is read from MM_PASSWORD or prompted for')
+  parser.add_argument('-a', required=True, nargs='+', metavar="ADDRESS_SPACE", help="Address Space IDs or Names, space or comma separated, or 'all' for every address space")
+  parser.add_argument('-w', type=int, default=4, metavar='WORKERS', help='Address spaces fetched concurrently when reporting on more than one (default: 4)')
+  parser.add_argument('-p', type=int, default=1000, metavar='PAGE_SIZE', help='Number of ranges fetched per request, 0 fetches them all in one request (default: 1000)')
+  parser.add_argument('--pool-size', type=int, default=10, metavar='N', help='Max pooled keep-alive connections to the server (default: 10)')
+  parser.add_argument('--page-workers', type=int, default=1, metavar='N', help='Ranges pages of an address space fetched concurrently, at most --pool-size, not used with --stream-json (default: 1)')
+  parser.add_argument('--timeout', type=float, default=300, metavar='SECONDS', help='Read timeout per api call (default: 300)')
+  parser.add_argument('--retries', type=int, default=3, metavar='N', help='Retries with exponential backoff on 429s, 5xx errors and connection resets (default: 3)')
+  parser.add_argument('--rate-limit', type=float, metavar='CALLS', help='Most api calls a second across all workers, the ceiling with --adaptive-rate (default: no limit, 50 with --adaptive-rate)')
+  parser.add_argument('--adaptive-rate', action='store_true', help='Halve the rate limit while the server answers 429/503 or slows down and ramp it back up as it recovers')
+  parser.add_argument('--stream-json', action='store_true', help='Decode range responses a range at a time as they download to keep memory down, these responses are not cached')
+  parser.add_argument('--cache-dir', metavar='DIR', help='Cache api results on disk in this directory so repeated runs can skip downloads')
+  parser.add_argument('--cache-max-mb', type=float, default=500, metavar='MB', help='Size the cache is trimmed back to, least recently used first (default: 500)')
+  parser.add_argument('--cache-ttl', action='append', default=[], metavar='ENDPOINT=SECONDS', help='Override how long an endpoint stays cached, e.g. Ranges=3600 (defaults: ' + ', '.join(k+'='+str(v) for k, v in responseCache.DEFAULT_TTLS.items()) + ')')
+  parser.add_argument('-o', default='ip_range_utilisation_output.xlsx', metavar='OUTPUT_FILE', help='Report file, the extension picks the format: .xlsx, .csv or .parquet (default: ip_range_utilisation_output.xlsx)')
+  parser.add_argument('--format', choices=reportWriter.FORMATS, help='Report format, overrides the output file extension')
+  parser.add_argument('--split-sites', action='store_true', help='Also write the ranges of each SiteCode to their own sheet (or file for csv/parquet)')
+  parser.add_argument('--min-utilisation', type=float, metavar='PERCENT', help='Only report ranges at least this utilised')
+  rangeType = parser.add_mutually_exclusive_group()
+  rangeType.add_argument('--subnets-only', action='store_true', help='Only report subnets')
+  rangeType.add_argument('--containers-only', action='store_true', help='Only report containers')
+  parser.add_argument('--site-code', metavar='SITE_CODE', help='Only report ranges with this Site Code')
+  parser.add_argument('--name-pattern', metavar='PATTERN', help='Only report ranges whose name contains this')
+  parser.add_argument('--rollup', action='store_true', help='Add parent range, depth, child count, free addresses and rolled up utilisation columns from the container/subnet hierarchy, holds each address space in memory until it is complete')
+  parser.add_argument('--history', metavar='DB_FILE', help="Also store this run's ranges in a SQLite history database for 'diff'")
+  parser.add_argument('--checkpoint', metavar='DIR', help='Spill the ranges to this directory as they are fetched so an interrupted run can be picked up with --resume, removed once the report is written')
+  parser.add_argument('--resume', action='store_true', help='Replay the ranges spilled to --checkpoint by an interrupted run and only fetch the rest')
+  parser.add_argument('--metrics', metavar='METRICS_FILE', help='Write api call and phase timings here at the end of the run, json or a Prometheus textfile when it ends in .prom')
+  parser.add_argument('--save-index', metavar='INDEX_FILE', help="Also save a range index snapshot of every range for 'query' lookups, .gz to compress it, not with the range filters")
   parser.add_argument('-d', action="store_true", help='Enable debug mode')
   
   args = parser.parse_args(argv)
@@ -255,6 +1743,26 @@ def init(argv):
   server = args.s
   username = args.u
   address_space = args.a
+  page_size = args.p
+  stream_json = args.stream_json
+  workers = max(1, args.w)
+  report_file_name = args.o
+  report_format = args.format or reportWriter.formatFor(args.o)
+  split_sites = args.split_sites
+  rollup = args.rollup
+  index_file_name = args.save_index
+  metrics_file_name = args.metrics
+  history = historyStore(args.history) if args.history else None
+  range_index = rangeIndex() if args.save_index else None
+  page_spill = pageSpill(args.checkpoint) if args.checkpoint else None
+  resume = args.resume
+  range_filter = rangeFilter(
+    minUtilisation=args.min_utilisation,
+    subnetsOnly=args.subnets_only,
+    containersOnly=args.containers_only,
+    siteCode=args.site_code,
+    namePattern=args.name_pattern
+  )
 
   print(args)
   logging.info(args)
@@ -262,85 +1770,240 @@ def init(argv):
   if args.d:
     logging.getLogger().setLevel(logging.DEBUG)
 
-  password = getpass.getpass(prompt='Password:')
+  if args.resume and not args.checkpoint:
+    parser.error("--resume needs --checkpoint")
+  # the filters are pushed down to the server so the ranges they drop are never fetched to index
+  if args.save_index and not range_filter.isEmpty():
+    parser.error("--save-index can't be used with --min-utilisation, --subnets-only, --containers-only, --site-code or --name-pattern, the index would be missing the ranges they leave out")
+  if not 1 <= args.page_workers <= args.pool_size:
+    parser.error("--page-workers must be between 1 and --pool-size")
+  api.pageConcurrency = args.page_workers
+
+  if args.rate_limit is not None and args.rate_limit <= 0:
+    parser.error("--rate-limit must be more than 0")
+  if args.adaptive_rate or args.rate_limit:
+    api.limiter = rateLimiter(args.rate_limit or 50, adaptive=args.adaptive_rate)
+
+  try:
+    reportWriter.checkFormat(report_format)
+  except ImportError as e:
+    parser.error(str(e))
+
+  if args.cache_dir:
+    ttls = {}
+    for override in args.cache_ttl:
+      endpoint, _, seconds = override.partition("=")
+      try:
+        ttls[endpoint] = float(seconds)
+      except ValueError:
+        parser.error("--cache-ttl expects ENDPOINT=SECONDS, got '" + override + "'")
+    api.cache = responseCache(args.cache_dir, maxBytes=int(args.cache_max_mb * 1024 * 1024), ttls=ttls)
+
+  password = readPassword()
+
+  # One session for the whole run so calls reuse the same connections
+  api.openSession(poolSize=args.pool_size, retries=args.retries, timeout=(10, args.timeout))
 
   logging.debug('Finished initialising script ')
 
 ################################################################################
+# query mode, answers which range each IP belongs to from a range index snapshot
+
+def query(argv):
+  global username
+  global password
+  global server
+  global page_size
+  global stream_json
+  global workers
+  global range_filter
+  global rollup
+  global history
+  global page_spill
+
+  initLogging()
+
+  parser = argparse.ArgumentParser(prog='men_and_mice_report.py query', description='Look up which range each IP address belongs to from a range index snapshot, built by a report run with --save-index or by passing -s/-u/-a here')
+  parser.add_argument('--index', required=True, metavar='INDEX_FILE', help='Range index snapshot to load, or to save when -s/-u/-a are given')
+  parser.add_argument('-i', nargs='+', default=[], metavar='IP', help='IP addresses to look up')
+  parser.add_argument('-f', metavar='IP_FILE', help='File of IP addresses to look up, one per line')
+  parser.add_argument('-o', metavar='OUTPUT_FILE', help='Write the results as csv to this file instead of the screen')
+  parser.add_argument('-s', metavar='HOSTNAME', help='Rebuild the index from this M&M server first')
+  parser.add_argument('-u', metavar='USERNAME', help='M&M username for rebuilding the index')
+  parser.add_argument('-a', nargs='+', metavar='ADDRESS_SPACE', help="Address spaces to rebuild the index from, or 'all'")
+  parser.add_argument('-w', type=int, default=4, metavar='WORKERS', help='Address spaces fetched concurrently when rebuilding (default: 4)')
+  parser.add_argument('-d', action="store_true", help='Enable debug mode')
+  args = parser.parse_args(argv)
+  logging.info(args)
+
+  if args.d:
+    logging.getLogger().setLevel(logging.DEBUG)
+  if args.s and not (args.u and args.a):
+    parser.error("rebuilding the index with -s also needs -u and -a")
+  if not args.s and not os.path.exists(args.index):
+    parser.error("index '" + args.index + "' doesn't exist, build it with -s/-u/-a or a report run with --save-index")
+
+  # Read the addresses before anything slow so a bad file fails fast
+  addresses = list(args.i)
+  if args.f:
+    with open(args.f) as f:
+      addresses += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+  if args.s:
+    server = args.s
+    username = args.u
+    page_size = 1000
+    stream_json = False
+    workers = max(1, args.w)
+    range_filter = rangeFilter()
+    rollup = False
+    history = None
+    page_spill = None
+    password = readPassword()
+    api.openSession()
+    index = rangeIndex()
+    if not runAddressSpaces(expandAddressSpaceInputs(args.a), None, index=index):
+      print("No address spaces could be indexed, exiting script with errors.")
+      quit()
+    index.save(args.index)
+    log_info("Saved range index: '" + args.index + "'")
+  else:
+    index = rangeIndex.load(args.index)
+
+  output = open(args.o, 'w', newline='') if args.o else sys.stdout
+  try:
+    csvWriter = csv.writer(output)
+    csvWriter.writerow(['ip', 'addressSpace', it.NAME, it.FROM, it.TO, 'SiteCode', it.TITLE])
+    lookupStart = time.perf_counter()
+    for address in addresses:
+      try:
+        matches = index.lookup(address)
+      except ValueError as e:
+        log_error("query lookup", e)
+        matches = []
+      if not matches:
+        csvWriter.writerow([address, '', '', '', '', '', ''])
+      for match in matches:
+        csvWriter.writerow([address, match['addressSpace'], match[it.NAME], match[it.FROM], match[it.TO], match['SiteCode'], match[it.TITLE]])
+    lookupTime = time.perf_counter() - lookupStart
+  finally:
+    if args.o:
+      output.close()
+  log_info("Looked up " + str(len(addresses)) + " addresses in " + str(round(lookupTime, 3)) + "s")
+
+################################################################################
+# diff mode, what changed between the last two runs stored in a history database
+
+def diff(argv):
+  initLogging()
+
+  parser = argparse.ArgumentParser(prog='men_and_mice_report.py diff', description='Report ranges that appeared, disappeared or grew in utilisation between the last two runs stored with --history')
+  parser.add_argument('--history', required=True, metavar='DB_FILE', help='History database written by report runs with --history')
+  parser.add_argument('-a', nargs='+', metavar='ADDRESS_SPACE', help='Address space names to compare, defaults to every one in the history')
+  parser.add_argument('--threshold', type=float, metavar='PERCENT', help='Report ranges whose utilisation has gone to at least this since the last run')
+  parser.add_argument('--growth', type=float, metavar='PERCENT', help='Report ranges whose utilisation rose by at least this many points since the last run')
+  parser.add_argument('-o', metavar='OUTPUT_FILE', help='Write the changes as csv to this file instead of the screen')
+  parser.add_argument('-d', action="store_true", help='Enable debug mode')
+  args = parser.parse_args(argv)
+  logging.info(args)
+
+  if args.d:
+    logging.getLogger().setLevel(logging.DEBUG)
+  if not os.path.exists(args.history):
+    parser.error("history database '" + args.history + "' doesn't exist, create it with a report run using --history")
+
+  store = historyStore(args.history)
+  output = open(args.o, 'w', newline='') if args.o else sys.stdout
+  try:
+    csvWriter = csv.writer(output)
+    csvWriter.writerow(['change', 'addressSpace', 'previousRun', 'latestRun', it.NAME, it.FROM, it.TO, 'previousUtilization', it.UTILIZATION_PERCENTAGE, 'SiteCode', it.TITLE])
+    for addressSpace in (args.a or store.addressSpaces()):
+      previous, latest = store.lastTwoRuns(addressSpace)
+      if previous is None:
+        log_info("Need two complete runs of '" + addressSpace + "' with the same filter to compare, skipping")
+        continue
+      changes = store.diff(previous[0], latest[0], threshold=args.threshold, growth=args.growth)
+      log_info(str(len(changes)) + " changes in '" + addressSpace + "' between " + previous[1] + " and " + latest[1])
+      for change in changes:
+        csvWriter.writerow([change[0], addressSpace, previous[1], latest[1]] + list(change[1:]))
+  finally:
+    store.close()
+    if args.o:
+      output.close()
+
+################################################################################
 
 
 def main(argv):
+  # 'query' is its own mode with its own arguments
+  if argv and argv[0] == 'query':
+    return query(argv[1:])
+  # and so is 'diff'
+  if argv and argv[0] == 'diff':
+    return diff(argv[1:])
+
   # Just make these global so I don't have to keep passing them around
   global username
   global password
   global server
   global address_space
+  global page_size
+  global stream_json
+  global workers
+  global report_file_name
+  global report_format
+  global split_sites
+  global rollup
+  global index_file_name
+  global metrics_file_name
+  global range_index
+  global history
+  global range_filter
+  global page_spill
 
   # initialise the script
   init(argv)
 
-  # Set the address space
-  selectAddressSpaceFromUserInput(address_space)
-
-  # Get the ranges report
-  ranges = api.getRanges()
-
-  # Build the ranges report
-  rangesArr = ranges['ranges']
-  minimisedRanges = []
-
-  log_info('Starting looping through ranges')
-  for range in rangesArr:
-    # temp variable to use for each loop to append to array
-    tempRangeAttributes = {}
-
-    # Check the customProperties exist and if so add to report
-    customProperties = range[it.CUSTOM_PROPS]
-    if it.TITLE in customProperties:
-        tempRangeAttributes[it.TITLE] = range[it.CUSTOM_PROPS][it.TITLE]
-    if it.DESCRIPTION in customProperties:
-        tempRangeAttributes[it.DESCRIPTION] = range[it.CUSTOM_PROPS][it.DESCRIPTION]
-    if it.SITE_CODE in customProperties:
-        tempRangeAttributes['SiteCode'] = range[it.CUSTOM_PROPS][it.SITE_CODE]
-
-    # Check for utilization, name and if is subnet
-    if it.UTILIZATION_PERCENTAGE in range:
-        tempRangeAttributes[it.UTILIZATION_PERCENTAGE] = range[it.UTILIZATION_PERCENTAGE]
-    if it.NAME in range:
-        tempRangeAttributes[it.NAME] = range[it.NAME]
-    if it.IS_SUBNET in range:
-        tempRangeAttributes[it.IS_SUBNET] = range[it.IS_SUBNET]
-    if it.IS_CONTAINER in range:
-        tempRangeAttributes[it.IS_CONTAINER] = range[it.IS_CONTAINER]
-    if it.FROM in range:
-        tempRangeAttributes[it.FROM] = range[it.FROM]
-    if it.TO in range:
-        tempRangeAttributes[it.TO] = range[it.TO]
-
-    # append to ranges
-    minimisedRanges.append(tempRangeAttributes)
-  log_info('Finished looping through ranges')
-
-  # create the data frame
-  # print report to file
-  columns = (
-    it.NAME, it.TITLE, 'SiteCode',
-    it.DESCRIPTION, it.UTILIZATION_PERCENTAGE,
-    it.FROM,it.TO,it.IS_SUBNET,
-    it.IS_CONTAINER
-  )
-  df = pd.DataFrame(data=minimisedRanges, columns=columns)
-  
-  # Used to fix a bug with illegal characters
-  df = df.applymap(lambda x: x.encode('unicode_escape').decode('utf-8') if isinstance(x, str) else x)
+  # Work out which address spaces we are reporting on
+  with metrics.phase('select'):
+    addressSpaceInputs = expandAddressSpaceInputs(address_space)
 
-  # Start building the report
+  # Fetch the address spaces concurrently, each worker uses its own session and streams into the report
+  # Keep the original single sheet name when only one address space was asked for
+  writer = reportWriter(report_file_name, format=report_format, splitSites=split_sites)
+  singleSheetName = reportWriter.DEFAULT_SHEET if len(addressSpaceInputs) == 1 else None
   log_info('Starting build of report')
-  reportFileName = "ip_range_utilisation_output.xlsx"
-  with pd.ExcelWriter(reportFileName) as writer:
-    df.to_excel(writer, index=False, sheet_name='ALL')
+  reportFileName = writer.fileName
+  succeeded = 0
+  try:
+    succeeded = runAddressSpaces(addressSpaceInputs, writer, singleSheetName, range_index)
+  finally:
+    with metrics.phase('write'):
+      writer.close()
+    if history is not None:
+      history.close()
+    # written even when the run fails, a slow or broken run is when the numbers matter most
+    if metrics_file_name:
+      metrics.write(metrics_file_name)
+      log_info("Wrote run metrics: '" + metrics_file_name + "'")
+
+  if not writer.hasOutput():
+    print("No address spaces could be reported on, exiting script with errors.")
+    quit()
+
   log_info("Completed building report: '" + reportFileName + "'")
 
+  # keep the spilled ranges for a --resume while any address space is still missing
+  if page_spill is not None:
+    if succeeded == len(addressSpaceInputs):
+      page_spill.clear()
+    else:
+      log_info("Kept the fetched ranges in '" + page_spill.directory + "', run again with --resume to fetch only the rest")
+
+  if range_index is not None:
+    range_index.save(index_file_name)
+    log_info("Saved range index: '" + index_file_name + "'")
+
   global start_time
   # calculate script execution time
   run_time = datetime.now() - start_time
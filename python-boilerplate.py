@@ -9,49 +9,234 @@
 #
 # Author: Western Wilson
 #
-import argparse
-import getpass
-import json
-import logging
+import argparse
+import atexit
+import csv
+import getpass
+import itertools
+import json
+import logging
+import logging.handlers
 import os
-import re
-import requests
-import sys
-import time
+import queue
+import re
+import sys
+import threading
+import time
 import traceback
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import quote, urlparse
 
-# Logging methods to standardise how threaded logs are written to, reminds me how to format strings nicely with methods
+# Logging methods to standardise how threaded logs are written to. Messages take %s style arguments which
+# are only formatted if the record is written, and then on the listener thread set up by initLogging()
 def log_error(message, exception=None, trace=None):
   if exception is None and trace is None:
-    logging.error('FAILED at [{}] with no exception error message recieved'.format(message))
+    logging.error('FAILED at [%s] with no exception error message recieved', message)
   elif trace is None:
-    logging.error('FAILED at [{}] error msg: [{}]'.format(message, exception))
+    logging.error('FAILED at [%s] error msg: [%s]', message, exception)
   elif exception is None:
-    logging.error('FAILED at [{}] error trace: {}'.format(message, trace))
+    logging.error('FAILED at [%s] error trace: %s', message, trace)
   else:
     # Both yes
-    logging.error('FAILED at [{}] error msg: [{}] error trace: {}'.format(message, exception, trace))
+    logging.error('FAILED at [%s] error msg: [%s] error trace: %s', message, exception, trace)
 
-def log_info(message):
-  print(message)
-  logging.info('{}'.format(message))
+# Also printed, by the listener's console handler
+def log_info(message, *args):
+  logging.info(message, *args, extra={'console': True})
 
-def log_debug(message):
-  logging.debug('{}'.format(message))
+def log_debug(message, *args):
+  logging.debug(message, *args)
+
+# Hands records to the listener as they are, rather than formatting them on the logging thread first like
+# QueueHandler does. Anything passed as an argument must not be changed after it is logged
+class deferredQueueHandler(logging.handlers.QueueHandler):
+  def prepare(self, record):
+    return record
+
+# Records are queued by whichever thread logs them and handled by a listener thread, which writes them to
+# ./logs/output.log and prints the ones flagged console, so api workers never wait on the file or the terminal
+def initLogging():
+  if not os.path.exists('./logs'):
+    os.makedirs('./logs')
+
+  root = logging.getLogger()
+  root.setLevel(logging.INFO)
+  if any(isinstance(handler, deferredQueueHandler) for handler in root.handlers):
+    return
+
+  fileHandler = logging.FileHandler('./logs/output.log', mode='a')
+  fileHandler.setFormatter(logging.Formatter(
+    '%(asctime)s sev=%(levelname)s file=%(filename)s module=%(name)s func=%(funcName)s %(message)s',
+    datefmt="%Y-%m-%d %H:%M:%S"
+  ))
+  consoleHandler = logging.StreamHandler(sys.stdout)
+  consoleHandler.addFilter(lambda record: getattr(record, 'console', False))
+  records = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(records, fileHandler, consoleHandler)
+  listener.start()
+  # write out whatever is still queued when the script exits, however it exits
+  atexit.register(listener.stop)
+  root.addHandler(deferredQueueHandler(records))
+
+# Short preview of a possibly huge request or response body for debug logs, with its full size.
+# Only worked out when the record is written, so it costs nothing with debug logging off
+class bodyPreview:
+  def __init__(self, data, limit=500):
+    self.data = data
+    self.limit = limit
+
+  def __str__(self):
+    data = self.data
+    size = len(data)
+    if isinstance(data, bytes):
+      data = data[:self.limit].decode('utf-8', errors='replace')
+    else:
+      data = data[:self.limit]
+    if size > self.limit:
+      data += '...'
+    return '(' + str(size) + ' bytes) ' + data
+
+# Client side rate limit shared by every api call, a token bucket of rate calls a second holding a single
+# token, so calls are spaced out evenly rather than let through in bursts after a quiet spell. When
+# adaptive the rate is halved when the server struggles (a 429, 503 or failed call, urllib3 having to
+# retry, or an endpoint's latency climbing to latencyFactor times its usual) and creeps back up while it
+# keeps up, never going above maxRate
+class rateLimiter:
+  # The rate is multiplied by this when the server struggles
+  DECREASE = 0.5
+  # Fraction of maxRate added back per second of healthy responses
+  INCREASE = 0.05
+  # Weight of the newest call in an endpoint's average latency
+  SMOOTHING = 0.2
+  # Weight of the newest call in an endpoint's usual latency, far slower so jitter averages out of it
+  BASELINE_SMOOTHING = 0.02
+  # Seconds the average latency has to be above the usual before latency alone counts as struggling,
+  # so a few ms of jitter on a fast endpoint is never taken for congestion
+  MIN_LATENCY_RISE = 0.05
+  CONGESTED_STATUSES = ('error', 429, 503)
+
+  def __init__(self, maxRate, adaptive=False, minRate=0.5, latencyFactor=2.0):
+    self.maxRate = float(maxRate)
+    self.rate = self.maxRate
+    self.minRate = min(minRate, self.maxRate)
+    self.adaptive = adaptive
+    self.latencyFactor = latencyFactor
+    self.burst = 1.0
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lastDecrease = 0.0
+    # endpoint -> [average latency, usual latency]
+    self.latencies = {}
+    self.lock = threading.Lock()
+
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  # Wait for a token. It is taken under the lock and slept for outside it, so waiting calls queue up in order
+  def acquire(self):
+    with self.lock:
+      self.refill(time.monotonic())
+      self.tokens -= 1
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+  # Feed back how a call went, status is the http status or 'error' when there was no response
+  def observe(self, endpoint, seconds, status, retries=0):
+    if not self.adaptive:
+      return
+    with self.lock:
+      now = time.monotonic()
+      latency = self.latencies.get(endpoint)
+      if latency is None:
+        latency = self.latencies[endpoint] = [seconds, seconds]
+      else:
+        latency[0] += (seconds - latency[0]) * rateLimiter.SMOOTHING
+        # the usual latency is a slow average rather than the fastest call seen, so a server that is
+        # slower for good is eventually taken as it is
+        latency[1] += (seconds - latency[1]) * rateLimiter.BASELINE_SMOOTHING
+      slow = latency[0] > self.latencyFactor * latency[1] and latency[0] - latency[1] >= rateLimiter.MIN_LATENCY_RISE
+      congested = status in rateLimiter.CONGESTED_STATUSES or retries or slow
+      self.refill(now)
+      if congested:
+        # the calls already in flight were sent at the old rate and the average latency takes a few calls
+        # to come down, so give a decrease a second or two round trips to work before halving again
+        if now - self.lastDecrease < max(1.0, 2 * latency[0]):
+          return
+        self.lastDecrease = now
+        self.rate = max(self.minRate, self.rate * rateLimiter.DECREASE)
+        log_info('Server struggling on %s (status %s, %.3fs), rate limit lowered to %.2f calls/s', endpoint, status, latency[0], self.rate)
+      elif self.rate < self.maxRate:
+        self.rate = min(self.maxRate, self.rate + rateLimiter.INCREASE * self.maxRate / self.rate)
 
 # api wrapper class for easy api operations
 class api:
+  # Shared keep-alive session, built by openSession() so every call reuses pooled connections
+  session = None
+  # (connect, read) timeout in seconds for every call
+  timeout = (10, 300)
+  # Pooled connections of the session, the default concurrency of getMany/postMany
+  poolSize = 10
+  # rateLimiter every call waits on, None for no limit
+  limiter = None
+
+  # Build the pooled session with retries and exponential backoff on 429s, 5xx errors and connection resets
+  def openSession(poolSize=10, retries=3, backoff=0.5, timeout=None):
+    # requests is only imported once a session is needed so -h and argument errors return straight away
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.auth = (username, password)
+    session.verify = False
+    retry = Retry(
+      total=retries,
+      backoff_factor=backoff,
+      # a 429 or 503 with a Retry-After header waits as long as the server asks
+      status_forcelist=(429, 500, 502, 503, 504),
+      # hand back the last response once retries run out so the status handling below still applies
+      raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    api.session = session
+    api.poolSize = poolSize
+    if timeout is not None:
+      api.timeout = timeout
+    return session
+
+  # Wait for the rate limiter, when there is one, before calling the server
+  def throttle():
+    if api.limiter is not None:
+      api.limiter.acquire()
+
+  # Tell the rate limiter how a call went, status is 'error' when there was no response
+  def observeCall(method, url, status, seconds, response=None):
+    if api.limiter is None:
+      return
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    endpoint = method + ' ' + re.sub(r'/\d+(?=/|$)', '/{id}', urlparse(url).path)
+    api.limiter.observe(endpoint, seconds, status, len(retries.history) if retries is not None and retries.history else 0)
+
   # An API GET call
   def getCall(url):
+    if api.session is None:
+      api.openSession()
+    api.throttle()
+    callStart = time.perf_counter()
     try:
-      myResponse = requests.get(url, auth=(username, password), verify=False)
+      myResponse = api.session.get(url, timeout=api.timeout)
     except:
+      api.observeCall('GET', url, 'error', time.perf_counter() - callStart)
       log_error('Failed get call for url: '+url, trace=traceback.format_exc())
       raise
       exit()
+    api.observeCall('GET', url, myResponse.status_code, time.perf_counter() - callStart, myResponse)
       
-    log_debug('Output from postCall:' + myResponse.text)
+    log_debug('Output from getCall: %s', bodyPreview(myResponse.content))
 
     if(myResponse.ok):
       rawreply = myResponse.content
@@ -62,27 +247,41 @@ class api:
       exit()
     else:
       log_error('API get call other status code Error!: '+url)
+      jNAData = json.loads(myResponse.content.decode())
       raise Exception(jNAData['error']['message'])
 
-# An API POST call
-  def postCall(url,postData):
+  # The message from an error body, M&M style {"error": {"message": ..}} or CouchDB style {"error": .., "reason": ..}
+  def errorMessage(jNAData):
+    error = jNAData.get('error') if isinstance(jNAData, dict) else None
+    if isinstance(error, dict):
+      return error.get('message')
+    return '{}: {}'.format(error, jNAData.get('reason')) if isinstance(jNAData, dict) else str(jNAData)
+
+# An API POST call, resultKey picks the part of the reply to return, None for the whole reply
+  def postCall(url,postData,resultKey='result'):
 
-    log_debug('Calling postData: '+postData)
+    log_debug('Calling postData: %s', bodyPreview(postData))
     
     headers = {'Content-type': 'application/json', 'Accept': '*/*'}
+    if api.session is None:
+      api.openSession()
+    api.throttle()
+    callStart = time.perf_counter()
     try:
-      myResponse = requests.post(url, auth=(username, password), data=postData, headers=headers, verify=False)
+      myResponse = api.session.post(url, data=postData, headers=headers, timeout=api.timeout)
     except Exception as e:
+      api.observeCall('POST', url, 'error', time.perf_counter() - callStart)
       message = 'Failed post call for url: '+ str(url)
       log_error(message,exception=e,trace=traceback.format_exc())
       exit()
+    api.observeCall('POST', url, myResponse.status_code, time.perf_counter() - callStart, myResponse)
 
-    log_debug('Output from postCall:' + myResponse.text)
+    log_debug('Output from postCall: %s', bodyPreview(myResponse.content))
 
     if myResponse.ok:
       rawreply = myResponse.content
       jNAData = json.loads(rawreply.decode())
-      return jNAData['result']
+      return jNAData if resultKey is None else jNAData[resultKey]
     elif myResponse.status_code == 404:
       log_error('API Error 404!')
       exit()
@@ -90,9 +289,163 @@ class api:
       rawreply = myResponse.content
       jNAData = json.loads(rawreply.decode())
       log_error('API Error unknown header!')
-      raise Exception(jNAData['error']['message'])
+      raise Exception(api.errorMessage(jNAData))
       exit()
 
+  # Run call on every item with at most concurrency calls in flight on the shared session. The results come
+  # back in input order as {'result': .., 'error': None} or {'result': None, 'error': message}, so one
+  # failed call is reported against its item instead of ending the whole batch
+  def runMany(call, items, concurrency=None):
+    if api.session is None:
+      api.openSession()
+    if concurrency is None:
+      concurrency = api.poolSize
+
+    def run(item):
+      try:
+        return {'result': call(item), 'error': None}
+      except SystemExit:
+        # getCall/postCall exit() on a 404 or a failed connection, it has already been logged
+        return {'result': None, 'error': 'API call failed, see the log'}
+      except Exception as e:
+        return {'result': None, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+      return list(executor.map(run, items))
+
+  # GET a list or iterator of urls concurrently, see runMany() for the results
+  def getMany(urls, concurrency=None):
+    return api.runMany(api.getCall, urls, concurrency)
+
+  # POST a list or iterator of (url, postData) pairs concurrently, see runMany() for the results
+  def postMany(calls, concurrency=None, resultKey='result'):
+    return api.runMany(lambda call: api.postCall(call[0], call[1], resultKey), calls, concurrency)
+
+################################################################################
+# Bulk loading the device csv into CouchDB
+
+# Devices from the csv one row at a time as documents, blank lines are skipped.
+# A blank _id is left out so CouchDB assigns one rather than rejecting the document
+def readDevices(fileName):
+  with open(fileName, newline='', encoding='utf-8-sig') as f:
+    for row in csv.DictReader(f):
+      if not any(row.values()):
+        continue
+      if not row.get('_id'):
+        row.pop('_id', None)
+      yield row
+
+# Group an iterable into lists of up to size items without reading ahead of the current batch
+def batches(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    batch = list(itertools.islice(iterator, size))
+    if not batch:
+      return
+    yield batch
+
+# Progress of a bulk load kept in a small json journal so a load that dies halfway can carry on with --resume:
+# how many batches have been sent and which of them failed. It is written after every round of requests and
+# when the load stops, so a crash only ever repeats the requests that were in flight (documents without an _id
+# are given a new one by CouchDB, repeating them inserts them twice). job names the input file, database and
+# batch size so it is never used for another load. A load that gets through every batch leaves its journal
+# marked complete, so --resume after it has finished sends nothing rather than starting over
+class batchJournal:
+  def __init__(self, fileName, job, done=0, retry=(), complete=False):
+    self.fileName = fileName
+    self.job = job
+    self.done = done
+    self.retry = set(retry)
+    self.complete = complete
+
+  # The journal saved in fileName for this job, or a fresh one when there isn't one or the one there is for a
+  # load that completed. ValueError if it is for another job that didn't complete
+  def load(fileName, job):
+    if not os.path.exists(fileName):
+      return batchJournal(fileName, job)
+    with open(fileName) as f:
+      saved = json.load(f)
+    if saved.get('job') != job:
+      if saved.get('complete'):
+        return batchJournal(fileName, job)
+      raise ValueError('journal ' + fileName + ' is for a different input file, database or batch size')
+    return batchJournal(fileName, job, saved['done'], saved['retry'], saved.get('complete', False))
+
+  # The numbered batches still to send, the ones that failed last time and everything after the last one sent
+  def pending(self, numbered):
+    for number, batch in numbered:
+      if number >= self.done or number in self.retry:
+        yield number, batch
+
+  def record(self, number, ok):
+    if ok:
+      self.retry.discard(number)
+    else:
+      self.retry.add(number)
+    self.done = max(self.done, number + 1)
+
+  # Save the journal, it is a few bytes so writing it after every round of requests costs next to nothing
+  def flush(self):
+    # swap the file in whole so a crash mid write leaves the last good journal
+    tempName = self.fileName + '.tmp'
+    with open(tempName, 'w') as f:
+      json.dump({'job': self.job, 'done': self.done, 'retry': sorted(self.retry), 'complete': self.complete}, f)
+    os.replace(tempName, self.fileName)
+
+  # The load got to the end, it is complete unless there are failed batches left to retry
+  def finish(self):
+    self.complete = not self.retry
+    self.flush()
+
+# Insert documents through _bulk_docs a batch per request, up to concurrency requests at a time, returns a
+# summary with each document that failed. CouchDB answers the whole batch with a result per document,
+# conflicts and other errors are collected rather than raised, as is every document of a request that failed.
+# With a journal the batches it has already sent are skipped and progress is recorded as batches complete
+def bulkInsert(server, db, docs, batchSize=500, concurrency=1, journal=None):
+  url = server.rstrip('/') + '/' + quote(db, safe='') + '/_bulk_docs'
+  summary = {'requests': 0, 'inserted': 0, 'conflicts': 0, 'errors': 0, 'failures': []}
+  numbered = enumerate(batches(docs, batchSize))
+  if journal is not None:
+    numbered = journal.pending(numbered)
+  try:
+    # only concurrency batches are read ahead of the requests in flight
+    for window in batches(numbered, concurrency):
+      outcomes = api.postMany([(url, json.dumps({'docs': batch})) for _, batch in window], concurrency, resultKey=None)
+      for (number, batch), outcome in zip(window, outcomes):
+        summary['requests'] += 1
+        if journal is not None:
+          journal.record(number, outcome['error'] is None)
+        if outcome['error'] is not None:
+          summary['errors'] += len(batch)
+          summary['failures'] += [{'id': doc.get('_id'), 'error': 'request_failed', 'reason': outcome['error']} for doc in batch]
+          log_error('Batch {} of {} devices not inserted'.format(number + 1, len(batch)), exception=outcome['error'])
+          continue
+        tallyResults(summary, outcome['result'])
+      if journal is not None:
+        journal.flush()
+      log_debug('%s requests done, %s inserted so far', summary['requests'], summary['inserted'])
+  except BaseException:
+    # whatever stopped the load, keep what has been done so --resume can carry on from it
+    if journal is not None:
+      journal.flush()
+    raise
+  if journal is not None:
+    journal.finish()
+  return summary
+
+# Add CouchDB's per document results of one _bulk_docs request to the summary
+def tallyResults(summary, results):
+  for result in results:
+    if 'error' not in result:
+      summary['inserted'] += 1
+      continue
+    if result['error'] == 'conflict':
+      summary['conflicts'] += 1
+    else:
+      summary['errors'] += 1
+    summary['failures'].append(result)
+    log_error('Document {} not inserted'.format(result.get('id')), exception='{}: {}'.format(result['error'], result.get('reason')))
+
 ################################################################################
 
 def init(argv):
@@ -100,25 +453,18 @@ def init(argv):
   global username
   global password
   global input_filename
+  global server
+  global db
+  global batch_size
+  global concurrency
+  global journal
   global start_time
 
   # Set debug to False by default
   global debug
   debug = False
   
-  if not os.path.exists('./logs'):
-    os.makedirs('./logs')
-    
-  # Setup the logger
-  logging.basicConfig(
-    filename='./logs/output.log',
-    filemode='a',
-    format='%(asctime)s sev=%(levelname)s file=%(filename)s module=%(name)s func=%(funcName)s %(message)s',
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level=logging.INFO
-  )
-  # Set the logger again as sometimes it keeps debug mode ???
-  logging.getLogger().setLevel(logging.INFO)
+  initLogging()
 
   start_time = datetime.now()
   
@@ -126,14 +472,56 @@ def init(argv):
 
   # Check the command line parameters are good:
   parser = argparse.ArgumentParser(description='Provide a list of devices in a file with your SBX_USERNAME and we\'ll return build a report')
-  parser.add_argument('-u', required=True, metavar='username', help='CouchDB Username')
+  parser.add_argument('-s', required=True, metavar='http://host:5984', help='CouchDB server url')
+  parser.add_argument('--db', required=True, metavar='database', help='CouchDB database to insert the devices into')
+  parser.add_argument('-u', required=True, metavar='username', help='CouchDB Username, the password is read from COUCHDB_PASSWORD or prompted for')
   parser.add_argument('-f', required=True, metavar='input-file.csv', help="The csv input file of devices to insert.")
+  parser.add_argument('--batch-size', type=int, default=500, metavar='N', help='Devices sent per _bulk_docs request (default: 500)')
+  parser.add_argument('-w', type=int, default=1, metavar='N', help='_bulk_docs requests in flight at once, at most --pool-size (default: 1)')
+  parser.add_argument('--journal', metavar='FILE', help='Where progress is recorded for --resume (default: ./logs/<input-file>.journal)')
+  parser.add_argument('--resume', action='store_true', help='Skip the batches an earlier interrupted load of the same file already sent, and retry the ones that failed')
+  parser.add_argument('--pool-size', type=int, default=10, metavar='N', help='Max pooled keep-alive connections to the server (default: 10)')
+  parser.add_argument('--rate-limit', type=float, metavar='CALLS', help='Most api calls a second, the ceiling with --adaptive-rate (default: no limit, 50 with --adaptive-rate)')
+  parser.add_argument('--adaptive-rate', action='store_true', help='Halve the rate limit while the server answers 429/503 or slows down and ramp it back up as it recovers')
+  parser.add_argument('--timeout', type=float, default=300, metavar='SECONDS', help='Read timeout per api call (default: 300)')
+  parser.add_argument('--retries', type=int, default=3, metavar='N', help='Retries with exponential backoff on 429s, 5xx errors and connection resets (default: 3)')
   parser.add_argument('-d', action="store_true", help='Enable debug mode')
   
   args = parser.parse_args(argv)
+  if args.batch_size < 1:
+    parser.error('--batch-size must be 1 or more')
+  if not 1 <= args.w <= args.pool_size:
+    parser.error('-w must be between 1 and --pool-size')
+  if args.rate_limit is not None and args.rate_limit <= 0:
+    parser.error('--rate-limit must be more than 0')
+  if not os.path.isfile(args.f):
+    parser.error('input file not found: ' + args.f)
   
   username = args.u
   input_filename = args.f
+  server = args.s
+  db = args.db
+  batch_size = args.batch_size
+  concurrency = args.w
+
+  # The journal is tied to this exact file, database and batch size, so a resume never skips the wrong rows
+  journal_filename = args.journal or os.path.join('./logs', os.path.basename(args.f) + '.journal')
+  stat = os.stat(args.f)
+  job = {'input': os.path.abspath(args.f), 'size': stat.st_size, 'modified': stat.st_mtime_ns, 'server': server, 'db': db, 'batchSize': batch_size}
+  if args.resume and not os.path.exists(journal_filename):
+    log_info('No journal at {}, starting from the beginning'.format(journal_filename))
+    journal = batchJournal(journal_filename, job)
+  elif args.resume:
+    try:
+      journal = batchJournal.load(journal_filename, job)
+    except ValueError as e:
+      parser.error(str(e) + ', run without --resume to start over')
+    if journal.complete:
+      log_info('{} has already been loaded in full according to {}, nothing to resume. Run without --resume to load it again'.format(args.f, journal_filename))
+      sys.exit(0)
+    log_info('Resuming from {}: {} batches sent, {} to retry'.format(journal_filename, journal.done, len(journal.retry)))
+  else:
+    journal = batchJournal(journal_filename, job)
 
   log_info(args)
 
@@ -144,7 +532,12 @@ def init(argv):
   input_filename = args.f
   log_info(input_filename)
 
-  password = getpass.getpass(prompt='Password:')
+  password = os.environ.get('COUCHDB_PASSWORD') or getpass.getpass(prompt='Password:')
+
+  # One session for the whole run so calls reuse the same connections
+  api.openSession(poolSize=args.pool_size, retries=args.retries, timeout=(10, args.timeout))
+  if args.adaptive_rate or args.rate_limit:
+    api.limiter = rateLimiter(args.rate_limit or 50, adaptive=args.adaptive_rate)
 
 
 def main(argv):
@@ -154,7 +547,15 @@ def main(argv):
   global server
 
   init(argv)
-  # TODO: Do the useful stuff
+
+  # Stream the devices into the database a batch per request
+  summary = bulkInsert(server, db, readDevices(input_filename), batch_size, concurrency, journal)
+  log_info('Inserted {} devices in {} requests, {} conflicts, {} errors'.format(
+    summary['inserted'], summary['requests'], summary['conflicts'], summary['errors']))
+  for failure in summary['failures'][:10]:
+    log_info('  {}: {} {}'.format(failure.get('id'), failure['error'], failure.get('reason')))
+  if len(summary['failures']) > 10:
+    log_info('  ... and {} more, see the log'.format(len(summary['failures']) - 10))
   
   global start_time
   # calculate script execution time